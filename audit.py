@@ -0,0 +1,168 @@
+# Runs any combination of the S3, RDS and VPC audits concurrently in a single process
+# Execute `python audit.py` from the cloned directory; `-h` gives help details
+import argparse
+import importlib
+import importlib.util
+import shlex
+import time
+import modules.checkpoint as ckp
+import modules.incremental as inc
+import modules.metrics as mt
+import modules.organization as org
+import modules.recorder as rec
+import modules.response_cache as rc
+import modules.regions as rg
+import modules.report_writer as rw
+import modules.run_options as ro
+import modules.tags as tg
+import modules.worker_pool as wp
+
+# Audits that can be selected, and the script module each one is run from
+audits = {'s3': 'audit_s3', 'rds': 'audit_rds', 'vpc': 'audit_vpc'}
+
+# Create argparse object and arguments
+parser = argparse.ArgumentParser(
+    description='Run the S3, RDS and VPC audits at the same time, sharing credentials, clients and the options below. Each audit writes the same report as its own script.')
+parser.add_argument('-a', '--audits', action='store', type=str, default='s3,rds,vpc',
+                    help='Comma separated audits to run. Defaults to s3,rds,vpc.',
+                    required=False)
+parser.add_argument('-r', '--region', action='store', type=str,
+                    help='The region to evaluate resources for. If not set, uses the default region specified in your profile.',
+                    required=False, default=None)
+parser.add_argument('-p', '--profile', action='store',
+                    help='AWS credential profile to run the audits under. Automatically uses "default" if no profile is specified.',
+                    required=False, default='default')
+parser.add_argument('-c', '--concurrency', action='store', type=int,
+                    help='The number of S3 buckets to evaluate at the same time. Defaults to 10.',
+                    required=False, default=10)
+for name in audits:
+    parser.add_argument('--' + name + '-options', action='store', type=str, default='', metavar='OPTIONS',
+                        help='Extra arguments for the ' + name.upper() + ' audit only, quoted as one string and joined with =, e.g. --' +
+                             name + '-options="' + {'s3': '-b my-bucket', 'rds': '-s', 'vpc': '-v vpc-1234'}[name] +
+                             '". Run its script with -h to see them.',
+                        required=False)
+org.add_organization_arguments(parser)
+rg.add_region_arguments(parser)
+tg.add_tag_arguments(parser)
+rc.add_cache_arguments(parser)
+rec.add_recording_arguments(parser)
+inc.add_incremental_arguments(parser)
+ckp.add_checkpoint_arguments(parser)
+rw.add_output_arguments(parser)
+mt.add_metrics_arguments(parser)
+
+
+def get_audit_names(args):
+    # Determines which audits to run from the cmd line arguments, exiting on an unknown name
+    names = [name.strip() for name in args.audits.split(',') if name.strip()]
+
+    for name in names:
+        if name not in audits:
+            parser.error('unknown audit "' + name + '"; choose from ' + ', '.join(audits))
+
+    return names
+
+
+def audit_arguments(module, name, args):
+    # Builds the arguments for one audit: its own options, plus every shared option it supports
+    # A shared option is only applied where the audit-specific options left the audit's default in place
+    audit_args = module.parser.parse_args(shlex.split(getattr(args, name + '_options')))
+
+    for key, value in vars(args).items():
+        if hasattr(audit_args, key) and getattr(audit_args, key) == module.parser.get_default(key):
+            setattr(audit_args, key, value)
+
+    return audit_args
+
+
+def load_audit(name):
+    # Loads a separate copy of an audit's script, with its own module-level state
+    # The scripts keep their arguments, clients and results in module globals set by run(), so each account of an
+    # organization run gets its own copy rather than sharing (and overwriting) one with the accounts running beside it
+    spec = importlib.util.find_spec(audits[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def run_audit(name, args, account_id=None):
+    # Imports and runs a single audit, so heavy libraries (e.g. pandas for RDS) are only loaded for the audits selected
+    # With an account ID, the audit runs against that account's assumed role and writes into the reports merged across accounts
+    module = importlib.import_module(audits[name]) if account_id == None else load_audit(name)
+    audit_args = audit_arguments(module, name, args)
+    if account_id != None:
+        audit_args.profile = org.get_account_profile(args, account_id)
+        audit_args.account_id = account_id
+    started = time.perf_counter()
+
+    # The scripts exit on fatal errors (e.g. a missing bucket); that only ends this audit, not the ones running beside it
+    try:
+        report_path = module.run(audit_args)
+    except SystemExit as error:
+        raise RuntimeError(name.upper() + ' audit exited with status ' + str(error.code)) from None
+
+    return report_path, time.perf_counter() - started
+
+
+def run_organization(args, names):
+    # Runs the selected audits against every account, at most --org-concurrency at a time across the whole organization,
+    # returning the (account ID, audit) pairs that failed
+    accounts = org.get_accounts(args)
+    print('Auditing ' + str(len(accounts)) + ' account(s) with the ' + args.role_name + ' role.')
+
+    units = [(account_id, name) for account_id in accounts for name in names]
+    failed = []
+    results = wp.run_concurrently(lambda unit: run_audit(unit[1], args, unit[0]), units, args.org_concurrency)
+
+    for (account_id, name), result, error in results:
+        if error != None:
+            print('ERROR: ' + name.upper() + ' audit of account ' + account_id + ' failed (' + type(error).__name__ + ': ' +
+                  str(error) + ').')
+            failed.append((account_id, name))
+            continue
+
+        report_path, seconds = result
+        print(name.upper() + ' audit of account ' + account_id + ' finished in ' + str(round(seconds, 1)) + 's.')
+
+    for path in rw.close_merged_reports():
+        print('Report for every account located in ' + path + '.')
+
+    return failed
+
+
+def run_audits(args, names):
+    # Runs the selected audits against the profile's own account at the same time, returning the names of those that failed
+    failed = []
+    for name, result, error in wp.run_concurrently(lambda name: run_audit(name, args), names, len(names)):
+        if error != None:
+            print('ERROR: ' + name.upper() + ' audit failed (' + type(error).__name__ + ': ' + str(error) + ').')
+            failed.append(name)
+            continue
+
+        report_path, seconds = result
+        print(name.upper() + ' audit finished in ' + str(round(seconds, 1)) + 's. Report located in ' + report_path + '.')
+
+    return failed
+
+
+def main():
+    args = parser.parse_args()
+    names = get_audit_names(args)
+
+    # Client options are applied once, so every audit shares the same sessions, clients, cache and archive
+    ro.configure(args)
+
+    if org.is_organization_run(args):
+        failed = run_organization(args, names)
+    else:
+        failed = run_audits(args, names)
+
+    ro.print_summaries()
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,489 @@
+# Keeps the S3, RDS and VPC reports current by re-checking only the resources named in CloudTrail change events
+# Execute `python audit_daemon.py --events QUEUE_URL_OR_PATH` from the cloned directory; `-h` gives help details
+import argparse
+import importlib
+import os
+import re
+import signal
+import time
+import audit
+import modules.build_client as bc
+import modules.discovery as dsc
+import modules.events as ev
+import modules.metrics as mt
+import modules.recorder as rec
+import modules.regions as rg
+import modules.report_writer as rw
+import modules.run_options as ro
+import modules.tags as tg
+from botocore.exceptions import ClientError
+
+# Create argparse object and arguments
+parser = argparse.ArgumentParser(
+    description='Audit every resource once, then keep the S3, RDS and VPC reports current by re-checking only the buckets, DB instances and VPCs named in CloudTrail change events. Reports are rewritten every --dump-interval seconds, on SIGUSR1 and on exit.')
+parser.add_argument('-a', '--audits', action='store', type=str, default='s3,rds,vpc',
+                    help='Comma separated audits to keep current. Defaults to s3,rds,vpc.',
+                    required=False)
+parser.add_argument('-r', '--region', action='store', type=str,
+                    help='The region to evaluate resources for. If not set, uses the default region specified in your profile.',
+                    required=False, default=None)
+parser.add_argument('-p', '--profile', action='store',
+                    help='AWS credential profile to run the daemon under. Automatically uses "default" if no profile is specified.',
+                    required=False, default='default')
+parser.add_argument('-c', '--concurrency', action='store', type=int,
+                    help='The number of S3 buckets to evaluate at the same time during the first sweep. Defaults to 10.',
+                    required=False, default=10)
+for name in audit.audits:
+    parser.add_argument('--' + name + '-options', action='store', type=str, default='', metavar='OPTIONS',
+                        help='Extra arguments for the ' + name.upper() + ' audit only, quoted as one string and joined with =, as for audit.py.',
+                        required=False)
+parser.add_argument('--dump-interval', action='store', type=float, default=300,
+                    help='How often (in seconds) the reports are rewritten. Defaults to 300.',
+                    required=False)
+parser.add_argument('--settle-interval', action='store', type=float, default=60,
+                    help='How long (in seconds) to wait before checking a DB instance again while it is still being created or modified. Defaults to 60.',
+                    required=False)
+ev.add_event_arguments(parser)
+rg.add_region_arguments(parser)
+tg.add_tag_arguments(parser)
+rec.add_recording_arguments(parser)
+rw.add_output_arguments(parser)
+mt.add_metrics_arguments(parser)
+
+# The response cache is never used: it would answer re-checks with the responses of the first sweep
+parser.set_defaults(cache=False)
+
+# Set from signal handlers and read by the event loop between polls
+requested = {'dump': False, 'stop': False}
+
+
+class Watcher:
+    # Holds one audit's report rows in memory by resource, and keeps them current as change events arrive
+    # Subclasses name the CloudTrail events that change their resources, find the resources an event is about and re-check one
+    # Audits scoped with IDs or --tag only follow the resources found by the first sweep
+
+    check_events = set()
+    delete_events = set()
+
+    def __init__(self, module, args):
+        self.module = module
+        self.args = args
+        self.index = {}
+        module.configure(args)
+
+    def columns(self):
+        return self.module.columns
+
+    def rows(self):
+        # Every row of the report, in the order the resources were first found
+        for rows in list(self.index.values()):
+            yield from rows
+
+    def remove(self, key):
+        self.index.pop(key, None)
+
+    def handle(self, record):
+        # Applies one CloudTrail record, returning the keys of resources that are still changing and should be checked again
+        event_name = record.get('eventName')
+        if event_name not in self.check_events and event_name not in self.delete_events:
+            return []
+
+        keys = self.resources(record)
+        if keys == None:
+            # The event doesn't say which resource it changed (e.g. DeleteFlowLogs), so its whole region is audited again
+            self.reload(record.get('awsRegion'))
+            print(event_name + ': ' + self.name.upper() + ' resources in ' + str(record.get('awsRegion')) + ' audited again.')
+            return []
+
+        keys = [key for key in keys if not self.is_scoped() or key in self.index]
+        if not keys:
+            return []
+
+        unsettled = []
+        if event_name in self.delete_events:
+            for key in keys:
+                self.remove(key)
+        else:
+            unsettled = [key for key in keys if self.check(key)]
+
+        action = 'removed' if event_name in self.delete_events else 're-checked'
+        print(event_name + ': ' + action + ' ' + self.resource_type + ' ' + ', '.join(self.describe(key) for key in keys) + '.')
+
+        return unsettled
+
+    def describe(self, key):
+        return key
+
+    def reload(self, region):
+        # Audits every resource again; regional watchers only audit the event's region
+        self.index = {}
+        self.load()
+
+
+class RegionalWatcher(Watcher):
+    # A watcher for regional resources, keyed by (region, ID); rows get a Region column when several regions are audited
+
+    def __init__(self, module, args):
+        super().__init__(module, args)
+
+        # Regions are kept by name, so events (which always carry one) can be matched against the profile's default region
+        self.regions = [region or bc.get_session(args.profile).region_name for region in rg.get_regions(args)]
+
+    def columns(self):
+        if rg.is_multi_region(self.args):
+            return ['Region'] + self.module.columns
+
+        return self.module.columns
+
+    def rows(self):
+        for key, rows in list(self.index.items()):
+            for row in rows:
+                yield [key[0]] + list(row) if rg.is_multi_region(self.args) else row
+
+    def describe(self, key):
+        return key[1] + ' (' + key[0] + ')'
+
+    def load(self):
+        # Audits every region in parallel, as the audit's own script does, then indexes the rows region by region
+        for region, entries in rg.audit_regions(lambda region: list(self.load_region(region)), self.regions):
+            for key, rows in entries:
+                self.set_rows(key, rows)
+
+    def reload(self, region):
+        if region not in self.regions:
+            return
+
+        for key in [key for key in self.index if key[0] == region]:
+            self.remove(key)
+        for key, rows in self.load_region(region):
+            self.set_rows(key, rows)
+
+    def set_rows(self, key, rows):
+        self.index[key] = rows
+
+    def in_regions(self, record):
+        return record.get('awsRegion') in self.regions
+
+
+class S3Watcher(Watcher):
+    # Bucket rows, keyed by bucket name; buckets are global, so events from every region are followed
+    name = 's3'
+    event_source = 's3.amazonaws.com'
+    report_name = 's3_public_data'
+    resource_type = 'bucket'
+    check_events = {'CreateBucket', 'PutBucketAcl', 'PutBucketPolicy', 'DeleteBucketPolicy', 'PutBucketPublicAccessBlock',
+                    'DeleteBucketPublicAccessBlock'}
+    delete_events = {'DeleteBucket'}
+
+    def is_scoped(self):
+        return self.args.bucket != None or bool(self.args.tag)
+
+    def load(self):
+        buckets = mt.timed('s3', 'discovery', self.module.get_s3_buckets())
+        for row in mt.timed('s3', 'evaluation', self.module.identify_public_buckets(buckets)):
+            self.index[row[0]] = [row]
+
+    def resources(self, record):
+        bucket = (record.get('requestParameters') or {}).get('bucketName')
+
+        return [bucket] if bucket else []
+
+    def remove(self, key):
+        # A bucket with the same name may be created again in another region, so its remembered region is dropped too
+        super().remove(key)
+        with self.module.bucket_regions_lock:
+            self.module.bucket_regions.pop(key, None)
+
+    def check(self, bucket):
+        try:
+            row = self.module.evaluate_bucket(bucket)
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchBucket':
+                self.remove(bucket)
+                return False
+            row = [bucket] + [self.module.describe_error(error)] * (len(self.module.columns) - 1)
+
+        self.index[bucket] = [row]
+
+        return False
+
+
+class RdsWatcher(RegionalWatcher):
+    # DB instance rows, keyed by (region, DB instance identifier); clusters and snapshots are left to the scheduled audits
+    name = 'rds'
+    event_source = 'rds.amazonaws.com'
+    report_name = 'rds_audit_data'
+    resource_type = 'DB instance'
+    check_events = {'CreateDBInstance', 'CreateDBInstanceReadReplica', 'ModifyDBInstance', 'RebootDBInstance',
+                    'StartDBInstance', 'StopDBInstance', 'PromoteReadReplica', 'RestoreDBInstanceFromDBSnapshot',
+                    'RestoreDBInstanceFromS3', 'RestoreDBInstanceToPointInTime', 'AddRoleToDBInstance',
+                    'RemoveRoleFromDBInstance'}
+    delete_events = {'DeleteDBInstance'}
+
+    # Statuses an instance rests in; in any other (creating, modifying, ...) its attributes are still changing
+    settled_statuses = {'available', 'stopped', 'storage-full', 'incompatible-parameters', 'inaccessible-encryption-credentials'}
+
+    def columns(self):
+        if rg.is_multi_region(self.args):
+            return ['Region'] + self.module.get_report_columns()
+
+        return self.module.get_report_columns()
+
+    def is_scoped(self):
+        return self.args.instance != None or bool(self.args.tag)
+
+    def load_region(self, region):
+        for row in self.module.audit_region(region).itertuples(index=False, name=None):
+            yield (region, row[0]), [row]
+
+    def resources(self, record):
+        if not self.in_regions(record):
+            return []
+
+        # Identifiers are stored in lowercase, whatever case they were given in; a rename is checked under both names
+        parameters = record.get('requestParameters') or {}
+        identifiers = [parameters.get('dBInstanceIdentifier') or parameters.get('targetDBInstanceIdentifier') or
+                       (record.get('responseElements') or {}).get('dBInstanceIdentifier'),
+                       parameters.get('newDBInstanceIdentifier')]
+
+        return [(record['awsRegion'], identifier.lower()) for identifier in identifiers if identifier]
+
+    def check(self, key):
+        region, identifier = key
+        rds = bc.build_client(self.args.profile, self.module.service, region)
+        instances = list(dsc.paginate_selected(rds, 'describe_db_instances', 'DBInstances', 'db-instance-id', {identifier}))
+        if not instances:
+            self.remove(key)
+            return False
+
+        self.index[key] = list(self.module.run_checks(instances).itertuples(index=False, name=None))
+
+        # Changes that aren't applied straight away only show once the instance is available again
+        instance = instances[0]
+        return instance.get('DBInstanceStatus') not in self.settled_statuses or bool(instance.get('PendingModifiedValues'))
+
+
+class VpcWatcher(RegionalWatcher):
+    # VPC rows (the VPC's line and one line per subnet), keyed by (region, VPC ID); subnets are mapped to their VPC,
+    # so a subnet event re-checks the VPC it belongs to
+    name = 'vpc'
+    event_source = 'ec2.amazonaws.com'
+    report_name = 'vpc_audit_data'
+    resource_type = 'VPC'
+    check_events = {'CreateVpc', 'CreateDefaultVpc', 'CreateSubnet', 'CreateDefaultSubnet', 'DeleteSubnet',
+                    'ModifySubnetAttribute', 'CreateFlowLogs', 'DeleteFlowLogs'}
+    delete_events = {'DeleteVpc'}
+
+    def __init__(self, module, args):
+        super().__init__(module, args)
+        self.subnets = {}
+
+    def is_scoped(self):
+        return self.args.vpc != None or bool(self.args.tag)
+
+    def load_region(self, region):
+        # VPC rows have the VPC ID in their first column, and are followed by their subnets' rows
+        key = None
+        rows = []
+        for row in self.module.audit_region(region):
+            if row[0] != '':
+                if key != None:
+                    yield key, rows
+                key = (region, row[0])
+                rows = []
+            rows.append(row)
+
+        if key != None:
+            yield key, rows
+
+    def set_rows(self, key, rows):
+        self.remove_subnets(key)
+        self.index[key] = rows
+        for row in rows:
+            if row[3] != '':
+                self.subnets[(key[0], row[3])] = key
+
+    def remove(self, key):
+        self.remove_subnets(key)
+        super().remove(key)
+
+    def remove_subnets(self, key):
+        for row in self.index.get(key, []):
+            self.subnets.pop((key[0], row[3]), None)
+
+    def resources(self, record):
+        # VPC and subnet IDs are picked out of the request and response wherever they appear, as each event nests them differently
+        if not self.in_regions(record):
+            return []
+
+        region = record['awsRegion']
+        ids = re.findall('\\b(?:vpc|subnet)-[0-9a-f]+\\b',
+                         str([record.get('requestParameters'), record.get('responseElements')]))
+        keys = []
+        unknown_subnets = False
+        for resource_id in dict.fromkeys(ids):
+            if resource_id.startswith('vpc-'):
+                keys.append((region, resource_id))
+            elif (region, resource_id) in self.subnets:
+                keys.append(self.subnets[(region, resource_id)])
+            else:
+                unknown_subnets = True
+
+        # A subnet the index doesn't know (e.g. one created since) only matters when the event doesn't name its VPC too
+        if not keys or (unknown_subnets and not any(key[1] in ids for key in keys)):
+            return None
+
+        return list(dict.fromkeys(keys))
+
+    def check(self, key):
+        region, vpc_id = key
+        ec2 = bc.build_client(self.args.profile, self.module.service, region)
+        if not list(dsc.paginate_selected(ec2, 'describe_vpcs', 'Vpcs', 'vpc-id', {vpc_id})):
+            self.remove(key)
+            return False
+
+        rows = self.module.populate_report([vpc_id], self.module.gather_subnets(ec2, {vpc_id}),
+                                           self.module.gather_flow_logs(ec2, {vpc_id}))
+        self.set_rows(key, list(rows))
+
+        return False
+
+
+# The watcher kept for each audit that can be selected
+watchers = {'s3': S3Watcher, 'rds': RdsWatcher, 'vpc': VpcWatcher}
+
+
+def get_audit_names(args):
+    # Determines which audits to keep current from the cmd line arguments, exiting on an unknown name
+    names = [name.strip() for name in args.audits.split(',') if name.strip()]
+
+    for name in names:
+        if name not in watchers:
+            parser.error('unknown audit "' + name + '"; choose from ' + ', '.join(watchers))
+
+    return names
+
+
+def start_watcher(name, args):
+    # Configures an audit's script with its own options and runs the first sweep into the watcher's index
+    module = importlib.import_module(audit.audits[name])
+    audit_args = audit.audit_arguments(module, name, args)
+    if getattr(audit_args, 'objects', False):
+        parser.error('--objects can\'t be kept current; run audit_s3.py --objects on a schedule instead')
+
+    watcher = watchers[name](module, audit_args)
+    started = time.perf_counter()
+    watcher.load()
+    print(name.upper() + ' audit indexed ' + str(len(watcher.index)) + ' ' + watcher.resource_type + '(s) in ' +
+          str(round(time.perf_counter() - started, 1)) + 's.')
+
+    return watcher
+
+
+def write_report(path, columns, rows):
+    # Writes a report next to its final path and then moves it into place, so readers never see a half written report
+    directory, file_name = os.path.split(path)
+    partial_path = os.path.join(directory, '.' + file_name)
+
+    with rw.ReportWriter(partial_path, columns) as report:
+        report.write_rows(rows)
+    os.replace(partial_path, path)
+
+
+def dump_reports(args, started_watchers):
+    # Writes every watcher's current rows to its audit's usual report
+    for watcher in started_watchers:
+        with mt.stage(watcher.name, 'report'):
+            write_report(rw.report_path(args, watcher.report_name), watcher.columns(), watcher.rows())
+
+    print('Reports written to ' + args.output_dir + ' at ' + time.strftime('%H:%M:%S') + '.')
+
+
+def request_dump(signum, frame):
+    requested['dump'] = True
+
+
+def request_stop(signum, frame):
+    requested['stop'] = True
+
+
+def handle_record(record, watchers_by_source):
+    # Passes a CloudTrail record to the watcher for its service, returning the keys to check again later
+    # Failed API calls changed nothing, and a record that can't be handled is reported without stopping the daemon
+    watcher = watchers_by_source.get(record.get('eventSource'))
+    if watcher == None or record.get('errorCode'):
+        return []
+
+    try:
+        return [(watcher, key) for key in watcher.handle(record)]
+    except (Exception, SystemExit) as error:
+        print('WARNING: Could not handle ' + str(record.get('eventName')) + ' (' + type(error).__name__ + ': ' + str(error) + ').')
+        return []
+
+
+def check_again(deferred, settle_interval):
+    # Checks resources that were still changing once their wait is over, waiting again for any that still are
+    now = time.monotonic()
+    for (watcher, key), due in list(deferred.items()):
+        if due > now:
+            continue
+
+        del deferred[(watcher, key)]
+        try:
+            if watcher.check(key):
+                deferred[(watcher, key)] = now + settle_interval
+            else:
+                print('Re-checked ' + watcher.resource_type + ' ' + watcher.describe(key) + ' after it settled.')
+        except (Exception, SystemExit) as error:
+            print('WARNING: Could not re-check ' + watcher.describe(key) + ' (' + type(error).__name__ + ': ' + str(error) + ').')
+
+
+def follow_events(args, source, started_watchers):
+    # Applies events as they arrive until asked to stop, writing the reports on every interval and SIGUSR1
+    watchers_by_source = {watcher.event_source: watcher for watcher in started_watchers}
+    deferred = {}
+    next_dump = time.monotonic() + args.dump_interval
+
+    while not requested['stop']:
+        timeout = min([next_dump] + list(deferred.values())) - time.monotonic()
+        for record in source.poll(max(0, timeout)):
+            for watcher_key in handle_record(record, watchers_by_source):
+                deferred[watcher_key] = time.monotonic() + args.settle_interval
+        source.acknowledge()
+
+        check_again(deferred, args.settle_interval)
+
+        if requested['dump'] or time.monotonic() >= next_dump:
+            requested['dump'] = False
+            dump_reports(args, started_watchers)
+            next_dump = time.monotonic() + args.dump_interval
+
+
+def main():
+    args = parser.parse_args()
+    names = get_audit_names(args)
+
+    # Client options are applied once, so every audit shares the same sessions and clients
+    ro.configure(args)
+    source = ev.open_source(args)
+
+    started_watchers = [start_watcher(name, args) for name in names]
+    dump_reports(args, started_watchers)
+
+    # SIGUSR1 writes the reports straight away; SIGTERM (like Ctrl+C) writes them one last time and stops
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, request_dump)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    print('Following change events from ' + args.events + '.')
+    try:
+        follow_events(args, source, started_watchers)
+    except KeyboardInterrupt:
+        pass
+
+    dump_reports(args, started_watchers)
+    ro.print_summaries()
+
+
+if __name__ == '__main__':
+    main()
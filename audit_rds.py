@@ -1,205 +1,584 @@
 # Import required libraries
 import argparse
-import pandas
+import datetime
+import itertools
+import os
 import modules.build_client as bc
+import modules.discovery as dsc
+import modules.incremental as inc
+import modules.metrics as mt
+import modules.recorder as rec
+import modules.response_cache as rc
+import modules.regions as rg
+import modules.report_writer as rw
+import modules.run_options as ro
+import modules.tags as tg
+import modules.worker_pool as wp
 from botocore.exceptions import ClientError
 
 # Create argparse object and arguments
 parser = argparse.ArgumentParser(
-    description='Check for RDS configurations in your AWS account. Groups of checks are outlined as arguments; if no group arguments (-b, -m, -s) are added, all checks are run.')
+    description='Check for RDS configurations in your AWS account. Groups of checks are selected with --checks (or -b, -m, -s); if no groups are selected, all checks are run.')
 parser.add_argument('-r', '--region', action='store', type=str,
                     help='The region to evaluate RDS resources for. If not set, uses the default region specified in your profile.',
                     required=False, default=None)
 parser.add_argument('-p', '--profile', action='store',
                     help='AWS credential profile to run the script under. Automatically uses "default" if no profile is specified.',
                     required=False, default='default')
-parser.add_argument('-i', '--instance', action='store',
-                    help='The friendly name of the single RDS instance to evaluate. If no instance is specified, automatically evaluates all instances in the account.',
+parser.add_argument('-i', '--instance', action='append',
+                    help='The friendly name of an RDS instance to evaluate; can be used more than once. If no instance (or --tag) is specified, automatically evaluates all instances in the account.',
                     required=False)
-parser.add_argument('-b', '--backups', action='store_true', help='Only run Backup/ Availability checks.',
+parser.add_argument('--checks', action='store', type=str, default=None,
+                    help='Comma separated check groups to run: backups, security, monitoring, logging, snapshots. If not set, every group is run.',
                     required=False)
-parser.add_argument('-s', '--security', action='store_true', help='Only run Security checks.', required=False)
-parser.add_argument('-m', '--monitoring', action='store_true', help='Only run Monitoring checks.', required=False)
-
-args = parser.parse_args()
+parser.add_argument('--automated-snapshots', action='store_true',
+                    help='Also check automated snapshots. By default only manual snapshots are fetched, as automated ones cannot be public, share their source\'s encryption and expire on their own.',
+                    required=False)
+parser.add_argument('-b', '--backups', action='store_true', help='Only run Backup/ Availability checks. Same as --checks backups.',
+                    required=False)
+parser.add_argument('-s', '--security', action='store_true', help='Only run Security checks. Same as --checks security.',
+                    required=False)
+parser.add_argument('-m', '--monitoring', action='store_true', help='Only run Monitoring checks. Same as --checks monitoring.',
+                    required=False)
+rg.add_region_arguments(parser)
+tg.add_tag_arguments(parser)
+rc.add_cache_arguments(parser)
+rec.add_recording_arguments(parser)
+inc.add_incremental_arguments(parser)
+rw.add_output_arguments(parser)
+mt.add_metrics_arguments(parser)
 
-# Create required RDS client
 service = 'rds'
-rds = bc.build_client(args.profile, service, args.region)
-
-
-# Begin defining functions
-def get_rds_instances(arg):
-    # Gather data about RDS instances
-
-    try:
-        if arg == None:
-            instance_data = rds.describe_db_instances()
-        elif arg != None:
-            # This method has options to use DB names, instance IDs and ARNs; should support checking any
-            instance_data = rds.describe_db_instances(DBInstanceIdentifier=arg)
-
-    except ClientError as error:
-        error = error.response['Error']['Code']
-        if error == 'InvalidClientTokenId':
-            print("Error: Invalid Client Token ID. Validate that the token is valid.")
-            exit(1)
-        elif error == 'AccessDenied' or error == 'UnauthorizedOperation':
-            print("Error: Access Denied. See README.md for IAM permissions required to execute this script.")
-            exit(2)
 
-    instance_data = instance_data['DBInstances']
+# The parsed arguments and incremental state are set by run() (or directly by code importing this script)
+# pandas is only imported once a report is built, so importing this script (or running other audits) stays fast
+args = None
+state = None
 
-    return instance_data
+# Resource types looked up with --tag, and the resources selected in each region audited so far (reset by run())
+tag_resource_types = ['rds:db', 'rds:cluster', 'rds:snapshot', 'rds:cluster-snapshot']
+scopes = {}
 
 
-def get_id_data(instance_data):
-    # Gather identifying data about instances
-    # Variables to return
-    id_data = {'DBInstanceIdentifier': [], 'Engine': [], 'DBInstanceStatus': []}
+# Begin defining functions
+def get_scope(region):
+    # Works out which resources of each type to audit in a region from -i and --tag, as a set of IDs per type (None means all of them)
+    # Tagged resources are looked up once per region and shared by the instance, cluster and snapshot checks
+    if region not in scopes:
+        scope = dict.fromkeys(tag_resource_types)
+        if args.tag:
+            scope = tg.get_tagged_ids(args.profile, region, args.tag, tag_resource_types)
+
+        scope['rds:db'] = tg.select(args.instance, scope['rds:db'])
+        scopes[region] = scope
+
+    return scopes[region]
+
+
+def get_rds_instances(rds, selected):
+    # Gather data about RDS instances, yielding each instance as its page of results arrives
+    # When instances are selected, only those are described, by passing their IDs as a filter
+    found_instances = set()
+    for instance in dsc.paginate_selected(rds, 'describe_db_instances', 'DBInstances', 'db-instance-id', selected):
+        found_instances.add(instance['DBInstanceIdentifier'])
+        yield instance
+
+    # When several regions are audited, the instances only need to exist in one of them
+    missing_instances = set(args.instance or []) - found_instances
+    if missing_instances and not rg.is_multi_region(args):
+        if not found_instances:
+            print('ERROR: Specified RDS instance does not exist in the current AWS account or Region.')
+            exit(3)
+        print('WARNING: Specified RDS instance(s) not found in the current AWS account or Region: ' +
+              ', '.join(sorted(missing_instances)) + '.')
+
+
+def get_rds_clusters(rds, selected=None):
+    # Gather data about Aurora and Multi-AZ DB clusters, yielding each cluster as its page of results arrives
+    yield from dsc.paginate_selected(rds, 'describe_db_clusters', 'DBClusters', 'db-cluster-id', selected)
+
+
+def get_snapshots(rds, scope):
+    # Streams the DB snapshots, then the DB cluster snapshots, in the region as records shaped for snapshot_checks
+    # Snapshot type, source instance and tagged snapshots are filtered server-side, so accounts with many snapshots don't page through them
+    options = {} if args.automated_snapshots else {'SnapshotType': 'manual'}
+    instances = scope['rds:db'] if args.instance != None else None
+
+    if scope['rds:snapshot'] != None:
+        # Tagged snapshots are filtered by ID, and then by the -i instances they were taken from
+        snapshots = dsc.paginate_selected(rds, 'describe_db_snapshots', 'DBSnapshots', 'db-snapshot-id', scope['rds:snapshot'], **options)
+        snapshots = (snapshot for snapshot in snapshots if instances == None or snapshot.get('DBInstanceIdentifier') in instances)
+    else:
+        snapshots = dsc.paginate_selected(rds, 'describe_db_snapshots', 'DBSnapshots', 'db-instance-id', instances, **options)
+
+    for snapshot in snapshots:
+        yield snapshot_record(snapshot, 'DB instance')
+
+    # Cluster snapshots are skipped when instances were asked for
+    if args.instance != None:
+        return
+
+    for snapshot in dsc.paginate_selected(rds, 'describe_db_cluster_snapshots', 'DBClusterSnapshots', 'db-cluster-snapshot-id',
+                                          scope['rds:cluster-snapshot'], **options):
+        yield snapshot_record(snapshot, 'DB cluster')
+
+
+def snapshot_record(snapshot, source_type):
+    # Normalises a DB or DB cluster snapshot into the attributes reported for both
+    if source_type == 'DB cluster':
+        identifier = snapshot['DBClusterSnapshotIdentifier']
+        source = snapshot.get('DBClusterIdentifier')
+        encrypted = snapshot.get('StorageEncrypted')
+    else:
+        identifier = snapshot['DBSnapshotIdentifier']
+        source = snapshot.get('DBInstanceIdentifier')
+        encrypted = snapshot.get('Encrypted')
+
+    created = snapshot.get('SnapshotCreateTime')
+    age = (datetime.datetime.now(datetime.timezone.utc) - created).days if created != None else None
+
+    return {'SnapshotIdentifier': identifier, 'SourceType': source_type, 'SourceIdentifier': source,
+            'SnapshotType': snapshot.get('SnapshotType'), 'Engine': snapshot.get('Engine'), 'SnapshotCreateTime': created,
+            'Public': None, 'Encrypted': encrypted, 'AgeDays': age}
+
+
+def is_snapshot_public(rds, record):
+    # Checks whether a snapshot can be restored by any AWS account; automated snapshots can't be shared, so need no call
+    if record['SnapshotType'] == 'automated':
+        return False
+
+    if record['SourceType'] == 'DB cluster':
+        result = rds.describe_db_cluster_snapshot_attributes(DBClusterSnapshotIdentifier=record['SnapshotIdentifier'])
+        attributes = result['DBClusterSnapshotAttributesResult']['DBClusterSnapshotAttributes']
+    else:
+        result = rds.describe_db_snapshot_attributes(DBSnapshotIdentifier=record['SnapshotIdentifier'])
+        attributes = result['DBSnapshotAttributesResult']['DBSnapshotAttributes']
+
+    return any(attribute['AttributeName'] == 'restore' and 'all' in attribute.get('AttributeValues', [])
+               for attribute in attributes)
+
+
+def chunks(items, size):
+    # Splits an iterable into lists of up to size items without reading ahead any further
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
 
-    # Populate id_data
-    for instance in instance_data:
-        id_data['DBInstanceIdentifier'].append(instance['DBInstanceIdentifier'])
-        id_data['Engine'].append(instance['Engine'])
-        id_data['DBInstanceStatus'].append(instance['DBInstanceStatus'])
 
-    return id_data
+def evaluate_snapshots(rds, snapshots):
+    # Checks snapshots a chunk at a time, yielding report rows only for those that don't pass every check,
+    # so memory use stays flat however many snapshots the account has
+    groups = ['snapshots']
+    check_names = [check.name for check in snapshot_checks.selected_checks(groups)]
 
+    for chunk in chunks(snapshots, snapshot_chunk_size):
+        for record, public, error in wp.run_concurrently(lambda record: is_snapshot_public(rds, record), chunk, snapshot_workers):
+            # A snapshot whose attributes can't be read is reported with an UNKNOWN result rather than aborting the run
+            if error != None:
+                print('WARNING: Could not check whether snapshot ' + record['SnapshotIdentifier'] + ' is public (' +
+                      type(error).__name__ + ').')
+            record['Public'] = public
 
-def run_backup_availability_checks(instance_data):
-    # If called, gathers data about backups and availability for the instance(s)
-    backup_data = {'BackupRetentionPeriod': [], 'MultiAZ': [], 'ReadReplicaDBInstanceIdentifiers': [],
-                   'DeletionProtection': []}
+        df = snapshot_checks.evaluate(chunk, groups)
+        yield from df[(df[check_names] != 'PASS').any(axis=1)].itertuples(index=False, name=None)
+
+
+class Check:
+    # A declarative pass/fail check of one attribute returned by the RDS API against a threshold
+    # comparison is one of the keys of comparisons below; for 'between', threshold is an inclusive (low, high) pair
+    # missing is the result for resources the attribute isn't returned for
+
+    def __init__(self, name, group, attribute, comparison, threshold, missing='UNKNOWN'):
+        self.name = name
+        self.group = group
+        self.attribute = attribute
+        self.comparison = comparison
+        self.threshold = threshold
+        self.missing = missing
+
+    def evaluate(self, df):
+        # Compares the whole attribute column at once, returning PASS/FAIL for every row
+        values = df[self.attribute]
+        passed = comparisons[self.comparison](values, self.threshold)
+
+        results = passed.map({True: 'PASS', False: 'FAIL'})
+        results[values.isna()] = self.missing
+
+        return results
+
+
+class CheckSet:
+    # The attributes and checks reported for one kind of RDS resource (instances, clusters, snapshots)
+    # id_attributes are always reported; each check group adds its own attributes and checks when it is selected
+
+    def __init__(self, id_attributes, check_groups, checks):
+        self.id_attributes = id_attributes
+        self.check_groups = check_groups
+        self.checks = checks
+
+    def applies_to(self, groups):
+        # Whether any of the selected groups has checks for this kind of resource
+        return any(check.group in groups for check in self.checks)
+
+    def attribute_columns(self, groups):
+        # The raw attributes reported for the selected check groups
+        columns = list(self.id_attributes)
+        for group in groups:
+            columns += self.check_groups.get(group, [])
+
+        return columns
+
+    def selected_checks(self, groups):
+        return [check for check in self.checks if check.group in groups]
+
+    def report_columns(self, groups):
+        # Attributes, then one column per check, then a summary of the failed checks
+        return self.attribute_columns(groups) + [check.name for check in self.selected_checks(groups)] + ['Failed Checks']
+
+    def evaluate(self, records, groups):
+        # Builds the report dataframe: every selected attribute is read from the records in a single pass,
+        # then each check is evaluated against a whole column at once
+        import pandas
+
+        df = pandas.DataFrame.from_records(list(records), columns=self.attribute_columns(groups))
+        failed_checks = pandas.Series('', index=df.index)
+
+        for check in self.selected_checks(groups):
+            df[check.name] = check.evaluate(df)
+            failed_checks += (df[check.name] == 'FAIL').map({True: check.name + '; ', False: ''})
+
+        df['Failed Checks'] = failed_checks.str.rstrip('; ')
+
+        return df
+
+
+def numeric(values):
+    # Numeric comparisons treat missing or non-numeric values as NaN, which never passes
+    import pandas
+
+    return pandas.to_numeric(values, errors='coerce')
+
+
+# Vectorized comparisons a check can use, each taking the attribute column and the check's threshold
+comparisons = {
+    '==': lambda values, threshold: (values == threshold).astype(bool),
+    '>=': lambda values, threshold: (numeric(values) >= threshold).astype(bool),
+    '<=': lambda values, threshold: (numeric(values) <= threshold).astype(bool),
+    'between': lambda values, threshold: numeric(values).between(*threshold).astype(bool),
+    'not empty': lambda values, threshold: values.map(lambda value: isinstance(value, list) and len(value) > 0).astype(bool),
+}
+
+# Check groups that can be selected with --checks, in report order
+group_names = ['backups', 'security', 'monitoring', 'logging', 'snapshots']
+
+# Snapshots are reported as failing once they are older than this many days
+stale_snapshot_days = 90
+
+instance_checks = CheckSet(
+    ['DBInstanceIdentifier', 'Engine', 'DBInstanceStatus'],
+    {
+        'backups': ['BackupRetentionPeriod', 'MultiAZ', 'ReadReplicaDBInstanceIdentifiers', 'DeletionProtection'],
+        'security': ['PubliclyAccessible', 'StorageEncrypted', 'IAMDatabaseAuthenticationEnabled', 'AssociatedRoles',
+                     'VpcSecurityGroups'],
+        'monitoring': ['MonitoringInterval', 'PerformanceInsightsEnabled'],
+        'logging': ['EnabledCloudwatchLogsExports'],
+    },
+    [
+        Check('Backup Retention >= 7 Days', 'backups', 'BackupRetentionPeriod', '>=', 7),
+        Check('Multi-AZ Enabled', 'backups', 'MultiAZ', '==', True),
+        Check('Deletion Protection Enabled', 'backups', 'DeletionProtection', '==', True),
+        Check('Not Publicly Accessible', 'security', 'PubliclyAccessible', '==', False),
+        Check('Storage Encrypted', 'security', 'StorageEncrypted', '==', True),
+        Check('IAM Database Authentication Enabled', 'security', 'IAMDatabaseAuthenticationEnabled', '==', True),
+        # An interval of 0 means enhanced monitoring is turned off
+        Check('Enhanced Monitoring <= 60s', 'monitoring', 'MonitoringInterval', 'between', (1, 60)),
+        Check('Performance Insights Enabled', 'monitoring', 'PerformanceInsightsEnabled', '==', True),
+        # The API leaves EnabledCloudwatchLogsExports out entirely when no logs are exported
+        Check('CloudWatch Log Exports Enabled', 'logging', 'EnabledCloudwatchLogsExports', 'not empty', None, missing='FAIL'),
+    ])
 
-    # Populate backup_data
-    for instance in instance_data:
-        backup_data['BackupRetentionPeriod'].append(instance['BackupRetentionPeriod'])
-        backup_data['MultiAZ'].append(instance['MultiAZ'])
-        backup_data['ReadReplicaDBInstanceIdentifiers'].append(instance['ReadReplicaDBInstanceIdentifiers'])
-        backup_data['DeletionProtection'].append(instance['DeletionProtection'])
+# Aurora (and Multi-AZ DB) clusters; monitoring and public access are set on each of a cluster's instances instead
+cluster_checks = CheckSet(
+    ['DBClusterIdentifier', 'Engine', 'Status'],
+    {
+        'backups': ['BackupRetentionPeriod', 'MultiAZ', 'DeletionProtection'],
+        'security': ['StorageEncrypted', 'IAMDatabaseAuthenticationEnabled', 'VpcSecurityGroups'],
+        'logging': ['EnabledCloudwatchLogsExports'],
+    },
+    [
+        Check('Backup Retention >= 7 Days', 'backups', 'BackupRetentionPeriod', '>=', 7),
+        Check('Multi-AZ Enabled', 'backups', 'MultiAZ', '==', True),
+        Check('Deletion Protection Enabled', 'backups', 'DeletionProtection', '==', True),
+        Check('Storage Encrypted', 'security', 'StorageEncrypted', '==', True),
+        Check('IAM Database Authentication Enabled', 'security', 'IAMDatabaseAuthenticationEnabled', '==', True),
+        Check('CloudWatch Log Exports Enabled', 'logging', 'EnabledCloudwatchLogsExports', 'not empty', None, missing='FAIL'),
+    ])
 
-    return backup_data
+# DB and DB cluster snapshots, normalised by snapshot_record() so both kinds share one report
+snapshot_checks = CheckSet(
+    ['SnapshotIdentifier', 'SourceType', 'SourceIdentifier', 'SnapshotType', 'Engine', 'SnapshotCreateTime'],
+    {'snapshots': ['Public', 'Encrypted', 'AgeDays']},
+    [
+        Check('Not Public', 'snapshots', 'Public', '==', False),
+        Check('Snapshot Encrypted', 'snapshots', 'Encrypted', '==', True),
+        Check('Newer Than ' + str(stale_snapshot_days) + ' Days', 'snapshots', 'AgeDays', '<=', stale_snapshot_days),
+    ])
 
+# Manual snapshots' public access is looked up this many at a time, and snapshots are checked in chunks of this size
+snapshot_workers = 10
+snapshot_chunk_size = 100
 
-def run_security_checks(instance_data):
-    # If called, gathers data about security for the instance(s)
-    security_data = {'PubliclyAccessible': [], 'StorageEncrypted': [], 'IAMDatabaseAuthenticationEnabled': [],
-                     'AssociatedRoles': [], 'VpcSecurityGroups': []}
-
-    # Populate security data
-    for instance in instance_data:
-        security_data['PubliclyAccessible'].append(instance['PubliclyAccessible'])
-        security_data['StorageEncrypted'].append(instance['StorageEncrypted'])
-        security_data['IAMDatabaseAuthenticationEnabled'].append(instance['IAMDatabaseAuthenticationEnabled'])
-        security_data['AssociatedRoles'].append(instance['AssociatedRoles'])
-        security_data['VpcSecurityGroups'].append(instance['VpcSecurityGroups'])
 
-    return security_data
+def get_selected_groups():
+    # Determines which check groups to run from --checks and the -b/-s/-m shortcuts; if none are chosen, every group is run
+    selected = [group.strip() for group in (args.checks or '').split(',') if group.strip()]
+
+    # The -b/-s/-m shortcuts are stored under their group's name
+    selected += [group for group in group_names if getattr(args, group, False) == True]
+
+    for group in selected:
+        if group not in group_names:
+            print('ERROR: Unknown check group "' + group + '". Choose from: ' + ', '.join(group_names) + '.')
+            exit(4)
+
+    if not selected:
+        return list(group_names)
+
+    # Groups are always reported in registry order, however they were passed in
+    return [group for group in group_names if group in selected]
+
+
+def get_attribute_columns():
+    # The raw instance attributes reported for the selected check groups
+    return instance_checks.attribute_columns(get_selected_groups())
+
+
+def get_selected_checks():
+    return instance_checks.selected_checks(get_selected_groups())
+
+
+def get_report_columns():
+    # Determines the instance report columns based on which checks are run
+    return instance_checks.report_columns(get_selected_groups())
+
+
+def create_rds_df(instance_data):
+    # Builds the instance report dataframe from the selected checks
+    return instance_checks.evaluate(instance_data, get_selected_groups())
+
+
+def create_report(name, report_columns, rows):
+    # Streams report rows into the named report, returning its path
+    # Rows are written through modules/report_writer so every format is supported, and nested values stay native in JSON lines/Parquet
+    with rw.open_report(args, name, report_columns) as report:
+        report.write_rows(rows)
+
+    return report.path
 
 
-def run_monitoring_checks(instance_data):
-    # If called, gathers data about monitoring for the instance(s)
-    monitoring_data = {'MonitoringInterval': [], 'PerformanceInsightsEnabled': []}
+def create_rds_report(results_df):
+    # Uses the results_df from function and converts them into the report, returning its path
+    return create_report('rds_audit_data', results_df.columns, results_df.itertuples(index=False, name=None))
 
-    for instance in instance_data:
-        monitoring_data['MonitoringInterval'].append(instance['MonitoringInterval'])
-        monitoring_data['PerformanceInsightsEnabled'].append(instance['PerformanceInsightsEnabled'])
 
-    return monitoring_data
+def audit_region(region):
+    # Runs the RDS checks for one region and returns its dataframe
+    rds = bc.build_client(args.profile, service, region)
 
+    # Every check group reads the same instances, and the report is built column by column, so the pages are collected once here
+    with mt.stage('rds', 'discovery'):
+        instance_data = list(get_rds_instances(rds, get_scope(region)['rds:db']))
 
-def identify_and_run_checks(instance_data):
-    # Determines which checks need to be run, and returns data to be entered into DF
-    backup_data = None
-    security_data = None
-    monitoring_data = None
+    with mt.stage('rds', 'evaluation'):
+        if state != None:
+            return run_incremental_checks(rds.meta.region_name, instance_data)
 
-    if args.backups == False and args.security == False and args.monitoring == False:
-        backup_data = run_backup_availability_checks(instance_data)
-        security_data = run_security_checks(instance_data)
-        monitoring_data = run_monitoring_checks(instance_data)
+        return run_checks(instance_data)
 
-    if args.backups == True:
-        backup_data = run_backup_availability_checks(instance_data)
 
-    if args.security == True:
-        security_data = run_security_checks(instance_data)
+def audit_region_clusters(region):
+    # Runs the cluster checks for one region and returns its dataframe
+    rds = bc.build_client(args.profile, service, region)
 
-    if args.monitoring == True:
-        monitoring_data = run_monitoring_checks(instance_data)
+    with mt.stage('rds', 'discovery'):
+        clusters = list(get_rds_clusters(rds, get_scope(region)['rds:cluster']))
 
-    return backup_data, security_data, monitoring_data
+    with mt.stage('rds', 'evaluation'):
+        return cluster_checks.evaluate(clusters, get_selected_groups())
 
 
-def create_rds_df(id_data, backup_data, security_data, monitoring_data):
-    # Creates dataframe that will be used to generate CSV report
-    default_columns = ['DBInstanceIdentifier', 'Engine', 'DBInstanceStatus']
-    backup_columns = ['BackupRetentionPeriod', 'MultiAZ', 'ReadReplicaDBInstanceIdentifiers', 'DeletionProtection']
-    security_columns = ['PubliclyAccessible', 'StorageEncrypted', 'IAMDatabaseAuthenticationEnabled', 'AssociatedRoles',
-                        'VpcSecurityGroups']
-    monitoring_columns = ['MonitoringInterval', 'PerformanceInsightsEnabled']
+def audit_region_snapshots(region):
+    # Streams the report rows of the snapshots in one region that fail a check
+    rds = bc.build_client(args.profile, service, region)
+    snapshots = mt.timed('rds', 'discovery', get_snapshots(rds, get_scope(region)))
 
-    # Append columns based on which checks are run
-    if args.backups == False and args.security == False and args.monitoring == False:
-        for column in backup_columns:
-            default_columns.append(column)
-        for column in security_columns:
-            default_columns.append(column)
-        for column in monitoring_columns:
-            default_columns.append(column)
+    return mt.timed('rds', 'evaluation', evaluate_snapshots(rds, snapshots))
 
-    if args.backups == True:
-        for column in backup_columns:
-            default_columns.append(column)
 
-    if args.security == True:
-        for column in security_columns:
-            default_columns.append(column)
+def merge_region_dfs(region_dfs):
+    # Merges the dataframes returned for each region into one, with the region as the first column
+    import pandas
 
-    if args.monitoring == True:
-        for column in monitoring_columns:
-            default_columns.append(column)
+    region_dfs = [region_df.assign(Region=region) for region, region_df in region_dfs]
+    with mt.stage('rds', 'evaluation'):
+        df = pandas.concat(region_dfs, ignore_index=True) if region_dfs else pandas.DataFrame(columns=['Region'])
+        return df[['Region'] + [column for column in df.columns if column != 'Region']]
 
-    # Create DF
-    rds_df = pandas.DataFrame(columns=list(default_columns))
 
-    # Add data from id_data
-    rds_df['DBInstanceIdentifier'] = id_data['DBInstanceIdentifier']
-    rds_df['Engine'] = id_data['Engine']
-    rds_df['DBInstanceStatus'] = id_data['DBInstanceStatus']
+def run_checks(instance_data):
+    # Runs the selected check groups against a list of instances and returns their dataframe
+    return create_rds_df(instance_data)
 
-    # Determine which variables to pack into DF
-    if backup_data != None:
-        rds_df['BackupRetentionPeriod'] = backup_data['BackupRetentionPeriod']
-        rds_df['MultiAZ'] = backup_data['MultiAZ']
-        rds_df['ReadReplicaDBInstanceIdentifiers'] = backup_data['ReadReplicaDBInstanceIdentifiers']
-        rds_df['DeletionProtection'] = backup_data['DeletionProtection']
 
-    # security data not packing in correctly
-    if security_data != None:
-        rds_df['PubliclyAccessible'] = security_data['PubliclyAccessible']
-        rds_df['StorageEncrypted'] = security_data['StorageEncrypted']
-        rds_df['IAMDatabaseAuthenticationEnabled'] = security_data['IAMDatabaseAuthenticationEnabled']
-        rds_df['AssociatedRoles'] = security_data['AssociatedRoles']
-        rds_df['VpcSecurityGroups'] = security_data['VpcSecurityGroups']
+def instance_fingerprint(instance):
+    # Status, pending modifications, creation time and every reported attribute all come back from describe_db_instances,
+    # so changes are detected without any extra API calls
+    return inc.fingerprint(instance.get('DBInstanceStatus'), instance.get('PendingModifiedValues'),
+                           instance.get('InstanceCreateTime'), [instance.get(column) for column in get_attribute_columns()])
 
-    if monitoring_data != None:
-        rds_df['MonitoringInterval'] = monitoring_data['MonitoringInterval']
-        rds_df['PerformanceInsightsEnabled'] = monitoring_data['PerformanceInsightsEnabled']
 
-    return rds_df
+def run_incremental_checks(region, instance_data):
+    # Reuses the previous run's rows for unchanged instances and only runs the checks against changed ones
+    import pandas
 
+    rows = {}
+    changed_instances = []
+    fingerprints = {}
 
-def create_rds_report(results_df):
-    # Uses the results_df from function and converts them into the CSV report
-    return results_df.to_csv('./output/rds_audit_data.csv', index=False)
+    for instance in instance_data:
+        key = str(region) + '/' + instance['DBInstanceIdentifier']
+        fingerprints[key] = instance_fingerprint(instance)
+        row = state.unchanged_row(key, fingerprints[key])
+
+        if row == None:
+            changed_instances.append(instance)
+        else:
+            rows[key] = row
+
+    # Record fresh results so the next run can skip these instances if they stay the same
+    for row in run_checks(changed_instances).values.tolist():
+        key = str(region) + '/' + row[0]
+        state.record(key, fingerprints[key], row)
+        rows[key] = row
+
+    # Rebuild the dataframe in the order the instances were discovered
+    ordered_rows = [rows[str(region) + '/' + instance['DBInstanceIdentifier']] for instance in instance_data]
+
+    return pandas.DataFrame(ordered_rows, columns=get_report_columns())
+
+
+def configure(run_args):
+    # Sets the arguments the functions above use, exiting on an unknown check group; called by run(), and by audit_daemon.py
+    global args, scopes
+    args = run_args
+    scopes = {}
+    rw.check_format(args.format)
+
+    # RDS stores instance identifiers in lowercase, so -i MyDatabase has to match mydatabase
+    if args.instance != None:
+        args.instance = [instance.lower() for instance in args.instance]
+    get_selected_groups()
+
+
+def create_cluster_report(regions):
+    # Runs the cluster checks in every region audited and writes their report
+    if regions != None:
+        cluster_df = merge_region_dfs(rg.audit_regions(audit_region_clusters, regions))
+    else:
+        cluster_df = audit_region_clusters(args.region)
+
+    with mt.stage('rds', 'report'):
+        cluster_path = create_report('rds_cluster_audit_data', cluster_df.columns,
+                                     cluster_df.itertuples(index=False, name=None))
+    print('RDS cluster(s) evaluated successfully. Report located in ' + cluster_path + '.')
+
+
+def create_snapshot_report(groups, regions):
+    # Runs the snapshot checks in every region audited and writes the snapshots failing a check to their report
+    # Only failing snapshots are held, so collecting them before the report is opened keeps memory small, and a snapshot
+    # listing that fails never leaves a half written report behind
+    snapshot_columns = snapshot_checks.report_columns(groups)
+    if regions != None:
+        rows = list(rg.prefix_region(rg.audit_regions(lambda region: list(audit_region_snapshots(region)), regions)))
+        snapshot_columns = ['Region'] + snapshot_columns
+    else:
+        rows = list(audit_region_snapshots(args.region))
+
+    with mt.stage('rds', 'report'):
+        snapshot_path = create_report('rds_snapshot_audit_data', snapshot_columns, rows)
+    print('RDS snapshots evaluated successfully. Snapshots failing a check are reported in ' + snapshot_path + '.')
+
+
+def run_optional_report(name, create):
+    # Cluster and snapshot checks need permissions beyond DescribeDBInstances; when one is missing, that report is skipped
+    # with a warning rather than ending an audit whose instance report has already been written
+    try:
+        create()
+    except (ClientError, SystemExit) as error:
+        reason = error.response['Error']['Code'] if isinstance(error, ClientError) else 'exited with status ' + str(error.code)
+        print('WARNING: Skipped the RDS ' + name + ' report (' + reason + '). See README.md for the permissions it needs.')
+
+
+def run(run_args):
+    # Runs the RDS audit with arguments parsed by parser, returning the path of the report it wrote
+    # Shared client options (rate limiting, cache, record/replay) are applied beforehand by modules/run_options
+    global state
+    configure(run_args)
+
+    # In incremental mode, results from the previous run are loaded so unchanged instances can be skipped
+    # Each selection of check groups keeps its own state, so a run with --checks doesn't replace a full run's results
+    state = None
+    if args.incremental:
+        state_name = 'rds_audit_data_state'
+        if get_selected_groups() != group_names:
+            state_name += '_' + '-'.join(get_selected_groups())
+
+        state = inc.IncrementalState(os.path.join(args.output_dir, rw.account_name(args, state_name) + '.json.gz'),
+                                      get_report_columns(), args.max_age,
+                                      {check.name: 'PASS' for check in get_selected_checks()})
+
+    # Regions are audited in parallel and merged into one report with a Region column
+    # Only a listing of every instance, in every region asked for, shows which instances are gone
+    regions = None
+    complete = args.instance == None and not args.tag
+    if rg.is_multi_region(args):
+        regions = rg.get_regions(args)
+        print('Evaluating RDS instances in regions: ' + ', '.join(regions))
+        region_dfs = list(rg.audit_regions(audit_region, regions))
+        complete = complete and len(region_dfs) == len(regions)
+        df = merge_region_dfs(region_dfs)
+    else:
+        df = audit_region(args.region)
+
+    with mt.stage('rds', 'report'):
+        path = create_rds_report(df)
+    print("RDS Instance(s) evaluated successfully. Report located in " + path + ".")
+
+    if state != None:
+        state.save(complete)
+        delta_path = rw.report_path(args, 'rds_audit_data_delta')
+        changes = state.write_delta(args, 'rds_audit_data_delta', complete)
+        print(str(state.reused) + ' unchanged instance(s) reused from the previous run. ' + str(changes) +
+              ' change(s) since the previous run written to ' + delta_path + '.')
+
+    groups = get_selected_groups()
+
+    # Clusters are skipped when instances were asked for
+    if args.instance == None and cluster_checks.applies_to(groups):
+        run_optional_report('cluster', lambda: create_cluster_report(regions))
+
+    if snapshot_checks.applies_to(groups):
+        run_optional_report('snapshot', lambda: create_snapshot_report(groups, regions))
+
+    return path
 
 
 # Main block
-instance_data = get_rds_instances(args.instance)
-id_data = get_id_data(instance_data)
-backup_data, security_data, monitoring_data = identify_and_run_checks(instance_data)
-df = create_rds_df(id_data, backup_data, security_data, monitoring_data)
-create_rds_report(df)
-print("RDS Instance(s) evaluated successfully. Report located in ./output/rds_audit_data.csv.")
+if __name__ == '__main__':
+    options = parser.parse_args()
+    ro.configure(options)
+    run(options)
+    ro.print_summaries()
@@ -1,8 +1,21 @@
 # Import required libraries
 import argparse
-import pandas
+import os
+import threading
+import zlib
 import modules.build_client as bc
-from botocore.exceptions import ClientError
+import modules.checkpoint as ckp
+import modules.discovery as dsc
+import modules.incremental as inc
+import modules.metrics as mt
+import modules.recorder as rec
+import modules.regions as rg
+import modules.response_cache as rc
+import modules.report_writer as rw
+import modules.run_options as ro
+import modules.tags as tg
+import modules.worker_pool as wp
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Create argparse object and arguments
 parser = argparse.ArgumentParser(description='Check for public S3 buckets in your AWS account.')
@@ -13,55 +26,173 @@ parser.add_argument('-p', '--profile', action='store',
                     help='AWS credential profile to run the script under. Automatically uses "default" if no profile is specified.',
                     required=False, default='default')
 parser.add_argument('-b', '--bucket', action='append',
-                    help='The single bucket to evaluate. If no bucket is specified, automatically evaluates all buckets in the account.',
+                    help='A bucket to evaluate; can be used more than once. If no bucket (or --tag) is specified, automatically evaluates all buckets in the account.',
                     required=False)
+parser.add_argument('-c', '--concurrency', action='store', type=int,
+                    help='The number of buckets to evaluate at the same time. Defaults to 10.',
+                    required=False, default=10)
+parser.add_argument('--objects', action='store_true',
+                    help='Check the ACL of every object in the selected bucket(s) instead of the bucket-level checks. Only public objects (and errors) are reported.',
+                    required=False)
+parser.add_argument('--versions', action='store_true',
+                    help='With --objects, check every object version rather than only the current versions.',
+                    required=False)
+parser.add_argument('--prefix', action='append',
+                    help='With --objects, a key prefix to scan as its own partition; can be used more than once. If not set, each top-level prefix of the bucket becomes a partition.',
+                    required=False)
+parser.add_argument('--sample-rate', action='store', type=float, default=1.0,
+                    help='With --objects, the fraction of objects to check, e.g. 0.01 for 1%%. Objects are sampled by key, so repeat runs check the same objects. Defaults to 1 (every object).',
+                    required=False)
+parser.add_argument('--partition-workers', action='store', type=int, default=4,
+                    help='With --objects, how many partitions are listed at the same time. Defaults to 4.',
+                    required=False)
+tg.add_tag_arguments(parser)
+rc.add_cache_arguments(parser)
+rec.add_recording_arguments(parser)
+inc.add_incremental_arguments(parser)
+ckp.add_checkpoint_arguments(parser)
+rw.add_output_arguments(parser)
+mt.add_metrics_arguments(parser)
+
+# Columns of the CSV report, in the order each bucket row is produced
+columns = ['Bucket Name', 'Public Block Enabled', 'Bucket Policy Public', 'Bucket ACL Public']
+# The value of each check column when the bucket passes; anything else is reported as a finding in incremental deltas
+passing = {'Public Block Enabled': True, 'Bucket Policy Public': False, 'Bucket ACL Public': False}
+object_columns = ['Bucket Name', 'Object Key', 'Version ID', 'Object ACL Public']
+all_users_uri = 'http://acs.amazonaws.com/groups/global/AllUsers'
+service = 's3'
 
-args = parser.parse_args()
+# The parsed arguments, S3 client, incremental state and progress journal are set by run() (or directly by code importing this script)
+# The s3 client is pinned to -r (or the profile's region) and lists buckets; per-bucket calls go through bucket_client()
+args = None
+s3 = None
+state = None
+journal = None
 
-# Create required S3 clients
-service = 's3'
-s3 = bc.build_client(args.profile, service, args.region)
+# The region each bucket lives in, by name; filled from list_buckets where it reports them, otherwise looked up once per bucket
+bucket_regions = {}
+bucket_regions_lock = threading.Lock()
 
 
 # Begin defining functions
+def get_tag_regions(buckets):
+    # The regions tagged buckets are looked up in: every region the listed buckets are located in
+    # Where list_buckets doesn't report a bucket's region (BucketRegion), every region enabled for the account is asked instead
+    regions = {bucket_regions.get(bucket['Name']) for bucket in buckets}
+    if None not in regions:
+        return sorted(regions)
+
+    ec2 = bc.build_client(args.profile, 'ec2', s3.meta.region_name)
+    return sorted(region['RegionName'] for region in ec2.describe_regions()['Regions'])
+
+
+def get_selected_buckets(buckets):
+    # Determines which of the listed buckets to evaluate from -b and --tag, returning a set of names, or None for every bucket
+    # The tagging API is regional and only returns buckets located in the region it is asked in, so each region is asked
+    tagged_buckets = None
+    if args.tag:
+        tagged_buckets = set()
+        for region, tagged_ids in rg.audit_regions(lambda region: tg.get_tagged_ids(args.profile, region, args.tag, ['s3']),
+                                                   get_tag_regions(buckets)):
+            tagged_buckets |= tagged_ids['s3']
+
+    return tg.select(args.bucket, tagged_buckets)
+
+
 def get_s3_buckets():
-    # Gathers names of all S3 buckets in the account which access keys are configured for
-    bucket_names = []
+    # Gathers all S3 buckets (name and creation date) in the account which access keys are configured for, yielding them as pages arrive
+    buckets = remember_bucket_regions(dsc.paginate(s3, 'list_buckets', 'Buckets'))
+
+    # With --tag, the regions to look tags up in are only known once every bucket has been listed
+    if args.tag:
+        buckets = list(buckets)
+    selected_buckets = get_selected_buckets(buckets)
 
-    # Gather list of buckets to either compare args to or return
+    # If no buckets are specified, simply return gathered buckets
+    if selected_buckets is None:
+        print('No bucket specified; evaluating all buckets in the account.')
+        yield from buckets
+        return
+
+    # If buckets are specified, only those are evaluated; the listing is one call per 10,000 buckets, so it is still used
+    # for their creation dates, and to report specified buckets that don't exist
+    specified_buckets = set(args.bucket or [])
+    existing_buckets = set()
+    selected_count = 0
+    for bucket in buckets:
+        if bucket['Name'] in specified_buckets:
+            existing_buckets.add(bucket['Name'])
+        if bucket['Name'] in selected_buckets:
+            selected_count += 1
+            yield bucket
+
+    missing_buckets = specified_buckets - existing_buckets
+    if missing_buckets and not existing_buckets:
+        print('ERROR: Specified bucket does not exist in the current AWS account.')
+        exit(3)
+    elif missing_buckets:
+        print('WARNING: Specified bucket(s) not found in the current AWS account: ' + ', '.join(sorted(missing_buckets)) + '.')
+
+    if selected_count == 0:
+        print('No buckets match the specified bucket(s) and tags.')
+
+
+def remember_bucket_regions(buckets):
+    # Passes listed buckets through, noting the region list_buckets reports for each one (BucketRegion), so they need no lookup
+    for bucket in buckets:
+        if bucket.get('BucketRegion'):
+            with bucket_regions_lock:
+                bucket_regions[bucket['Name']] = bucket['BucketRegion']
+        yield bucket
+
+
+def location_region(location_constraint):
+    # Converts a GetBucketLocation result to a region name; buckets in us-east-1 have no location constraint,
+    # and the oldest buckets in eu-west-1 report EU
+    if not location_constraint:
+        return 'us-east-1'
+    if location_constraint == 'EU':
+        return 'eu-west-1'
+
+    return location_constraint
+
+
+def lookup_bucket_region(bucket):
+    # Asks S3 which region a bucket is in; HeadBucket is the fallback when GetBucketLocation isn't allowed, as S3 reports
+    # the region in the x-amz-bucket-region header of its response, even for redirects and access denied errors
     try:
-        buckets = s3.list_buckets()
-    except ClientError as error:
-        error = error.response['Error']['Code']
-        if error == 'InvalidClientTokenId':
-            print("Error: Invalid Client Token ID. Validate that the token is valid.")
-            exit(1)
-        elif error == 'AccessDenied' or error == 'UnauthorizedOperation':
-            print("Error: Access Denied. See README.md for IAM permissions required to execute this script.")
-            exit(2)
+        return location_region(s3.get_bucket_location(Bucket=bucket).get('LocationConstraint'))
+    except ClientError as location_error:
+        try:
+            response = s3.head_bucket(Bucket=bucket)
+        except ClientError as head_error:
+            response = head_error.response
 
-    # Remove unnecessary keys from variable
-    buckets = buckets['Buckets']
+        region = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('x-amz-bucket-region')
+        if region == None:
+            raise location_error
 
-    # Loop through variable and create a list of names only
-    for name in buckets:
-        bucket_names.append(name['Name'])
+        return region
 
-    # If no buckets are specified, simply return gathered bucket names
-    if args.bucket is None:
-        print('No bucket specified; evaluating all buckets in the account.')
-        return bucket_names
 
-    # If buckets are specified, check that bucket exists and exit if not
-    elif args.bucket:
-        # Get string of bucket name specified in cmd line argument
-        bucket_specified = args.bucket[0]  # This only works while only one argument is passed in
+def get_bucket_region(bucket):
+    # Returns the region a bucket lives in, looking it up the first time it is needed
+    with bucket_regions_lock:
+        region = bucket_regions.get(bucket)
+    if region != None:
+        return region
+
+    region = lookup_bucket_region(bucket)
+    with bucket_regions_lock:
+        bucket_regions[bucket] = region
 
-        if bucket_specified in bucket_names:
-            return args.bucket
-        elif bucket_specified not in bucket_names:
-            print('ERROR: Specified bucket does not exist in the current AWS account.')
-            exit(3)
+    return region
+
+
+def bucket_client(bucket):
+    # Returns a client for the bucket's own region, so its calls reach the right endpoint on the first attempt instead of
+    # being redirected (301/PermanentRedirect) from the listing client's region; clients are cached per region by build_client
+    return bc.build_client(args.profile, service, get_bucket_region(bucket), max_pool_connections=args.concurrency)
 
 
 def get_block_public_access_rules(bucket):
@@ -69,7 +200,7 @@ def get_block_public_access_rules(bucket):
     public_block_results = []
 
     try:
-        block = s3.get_public_access_block(Bucket=bucket)
+        block = bucket_client(bucket).get_public_access_block(Bucket=bucket)
         block = block['PublicAccessBlockConfiguration']
         values = block.values()
 
@@ -90,9 +221,10 @@ def get_block_public_access_rules(bucket):
         error = error.response['Error']['Code']
         if error == 'NoSuchPublicAccessBlockConfiguration':
             public = "Validate manually - no configuration set"
+        else:
+            raise
 
-    finally:
-        public_block_results = public
+    public_block_results = public
 
     return public_block_results
 
@@ -100,13 +232,15 @@ def get_block_public_access_rules(bucket):
 def get_bucket_policy(bucket):
     # Checks for bucket policies that make the bucket public
     try:
-        bucket_policy_results = s3.get_bucket_policy_status(Bucket=bucket)
+        bucket_policy_results = bucket_client(bucket).get_bucket_policy_status(Bucket=bucket)
         bucket_policy_results = bucket_policy_results['PolicyStatus']['IsPublic']
 
     # Checks for non-existent bucket policy and sets result to False
     except ClientError as policy_error:
         if policy_error.response['Error']['Code'] == 'NoSuchBucketPolicy':
             bucket_policy_results = False
+        else:
+            raise
 
     return bucket_policy_results
 
@@ -116,7 +250,7 @@ def get_bucket_acl(bucket):
     bucket_acl_results = []
 
     # Bucket variable gets passed in from loop in identify_public_buckets()
-    bucket_acl = s3.get_bucket_acl(Bucket=bucket)
+    bucket_acl = bucket_client(bucket).get_bucket_acl(Bucket=bucket)
 
     # Remove unnecessary keys from variable
     bucket_acl = bucket_acl['Grants']
@@ -133,31 +267,248 @@ def get_bucket_acl(bucket):
     return bucket_acl_results
 
 
+def evaluate_bucket(bucket):
+    # Runs every bucket check for a single bucket; called from the worker pool in identify_public_buckets()
+    public_block = get_block_public_access_rules(bucket)
+    bucket_policy = get_bucket_policy(bucket)
+    bucket_acl = get_bucket_acl(bucket)
+
+    return [bucket, public_block, bucket_policy, bucket_acl]
+
+
+def get_bucket_fingerprint(bucket):
+    # list_buckets already returns the name and creation date, so a recreated bucket is spotted without extra calls
+    return inc.fingerprint(bucket['Name'], bucket.get('CreationDate'))
+
+
+def check_bucket(bucket):
+    # Evaluates one listed bucket and journals its result; when resuming, a bucket already in the journal isn't checked again
+    if journal == None:
+        return check_listed_bucket(bucket)
+
+    row = journal.completed_row(bucket['Name'])
+    if row != None:
+        if state != None:
+            state.record(bucket['Name'], get_bucket_fingerprint(bucket), row)
+        return row
+
+    row = check_listed_bucket(bucket)
+    journal.record(bucket['Name'], row)
+
+    return row
+
+
+def check_listed_bucket(bucket):
+    # Evaluates one listed bucket; in incremental mode, an unchanged bucket reuses its result from the previous run
+    if state == None:
+        return evaluate_bucket(bucket['Name'])
+
+    bucket_fingerprint = get_bucket_fingerprint(bucket)
+    row = state.unchanged_row(bucket['Name'], bucket_fingerprint)
+
+    if row == None:
+        row = evaluate_bucket(bucket['Name'])
+        state.record(bucket['Name'], bucket_fingerprint, row)
+
+    return row
+
+
+def describe_error(error):
+    # Converts an error raised while evaluating a bucket into a short value that can be written into the report
+    if isinstance(error, ClientError):
+        return 'Error: ' + error.response['Error']['Code']
+
+    return 'Error: ' + type(error).__name__
+
+
 def identify_public_buckets(all_buckets):
-    # Creates dataframe that will be used to generate CSV report and validates which parts of bucket permissions are public, if any
-    columns = ['Bucket Name', 'Public Block Enabled', 'Bucket Policy Public', 'Bucket ACL Public']
-    bucket_df = pandas.DataFrame(columns=list(columns))
+    # Validates which parts of bucket permissions are public, if any, yielding one report row per bucket as it finishes
+    # Buckets are evaluated concurrently, but results come back in the same order as all_buckets
+    for bucket, row, error in wp.run_concurrently(check_bucket, all_buckets, args.concurrency):
+        # A failure on one bucket is recorded in its row rather than aborting the whole run
+        if error != None:
+            print('WARNING: Could not evaluate bucket ' + bucket['Name'] + ' (' + describe_error(error) + ').')
+            row = [bucket['Name']] + [describe_error(error)] * (len(columns) - 1)
+
+            # Failed buckets get no fingerprint, so the next incremental run checks them again
+            if state != None:
+                state.record(bucket['Name'], None, row)
+            if journal != None:
+                journal.record_failure(bucket['Name'])
+
+        yield row
+
+
+def is_sampled(key):
+    # Decides from a hash of the key whether an object is part of the sample, so the same objects are picked every run
+    if args.sample_rate >= 1:
+        return True
+
+    return zlib.crc32(key.encode()) < args.sample_rate * 2 ** 32
+
+
+def page_objects(bucket, page):
+    # Yields (bucket, key, version ID, None) for the sampled objects of one listing page
+    if args.versions:
+        # Delete markers have no ACL, so only real versions are checked
+        for version in page.get('Versions', []):
+            if is_sampled(version['Key']):
+                yield bucket, version['Key'], version['VersionId'], None
+    else:
+        for item in page.get('Contents', []):
+            if is_sampled(item['Key']):
+                yield bucket, item['Key'], None, None
+
+
+def listing_operation():
+    return 'list_object_versions' if args.versions else 'list_objects_v2'
+
+
+def list_partition(bucket, prefix):
+    # Streams the objects of one partition of a bucket, page by page, so memory use doesn't depend on object count
+    # A listing that fails (e.g. AccessDenied, or a connection error once retries run out) ends the partition with
+    # (bucket, prefix, None, error), reported as an error row
+    try:
+        for page in dsc.paginate_pages(bucket_client(bucket), listing_operation(), Bucket=bucket, Prefix=prefix):
+            yield from page_objects(bucket, page)
+    except (ClientError, BotoCoreError) as error:
+        yield bucket, prefix, None, error
+
+
+def get_object_partitions(bucket):
+    # Splits a bucket into prefix partitions that can be listed by separate workers, yielding them as they are found
+    if args.prefix:
+        for prefix in args.prefix:
+            yield list_partition(bucket, prefix)
+        return
+
+    # One listing with a delimiter returns both the objects at the top of the bucket and its top-level prefixes,
+    # so each of its pages' objects form one partition, and each top-level prefix forms another
+    try:
+        for page in dsc.paginate_pages(bucket_client(bucket), listing_operation(), Bucket=bucket, Delimiter='/'):
+            yield list(page_objects(bucket, page))
+            for common_prefix in page.get('CommonPrefixes', []):
+                yield list_partition(bucket, common_prefix['Prefix'])
+    except (ClientError, BotoCoreError) as error:
+        yield [(bucket, '', None, error)]
+
+
+def check_object(item):
+    # Checks a single object (or object version) for an ACL grant to everyone
+    # A partition that couldn't be listed arrives with its error, so it is reported in place of its objects
+    bucket, key, version_id, listing_error = item
+    if listing_error != None:
+        raise listing_error
+
+    options = {'Bucket': bucket, 'Key': key}
+    if version_id != None:
+        options['VersionId'] = version_id
+
+    grants = bucket_client(bucket).get_object_acl(**options)['Grants']
+    public = any(grant['Grantee'].get('URI') == all_users_uri for grant in grants)
+
+    return [bucket, key, version_id or '', public]
+
+
+def identify_public_objects(all_buckets):
+    # Streams every object in the selected buckets through a bounded pool of ACL checks, yielding public objects and errors
+    # Partitions are listed in parallel and feed a bounded buffer, so memory stays flat however many objects there are
+    checked = 0
+    partitions = (mt.timed('s3', 'discovery', partition)
+                  for bucket in all_buckets for partition in get_object_partitions(bucket['Name']))
+    objects = wp.interleave(partitions, args.partition_workers, buffer_size=args.concurrency * 100)
+
+    for item, row, error in wp.run_concurrently(check_object, objects, args.concurrency):
+        if item[3] == None:
+            checked += 1
+
+        if error != None:
+            yield [item[0], item[1], item[2] or '', describe_error(error)]
+        elif row[3] == True:
+            yield row
+
+    print(str(checked) + ' object(s) checked.')
+
+
+def create_s3_object_report(results):
+    # Streams the rows from identify_public_objects function into the report as each one is produced, returning its path
+    with rw.open_report(args, 's3_object_acl_data', object_columns) as report:
+        report.write_rows(results)
+
+    return report.path
+
+
+def create_s3_report(results):
+    # Streams the rows from identify_public_buckets function into the report as each one is produced, returning its path
+    with rw.open_report(args, 's3_public_data', columns) as report:
+        report.write_rows(results)
+
+    return report.path
+
+
+def configure(run_args):
+    # Sets the arguments and S3 client the functions above use; called by run(), and by audit_daemon.py to re-check single buckets
+    global args, s3, bucket_regions
+    args = run_args
+    bucket_regions = {}
+    rw.check_format(args.format)
+
+    # Create required S3 clients, with a connection pool large enough for every worker thread
+    s3 = bc.build_client(args.profile, service, args.region, max_pool_connections=args.concurrency)
+
+
+def run(run_args):
+    # Runs the S3 audit with arguments parsed by parser, returning the path of the report it wrote
+    # Shared client options (rate limiting, cache, record/replay) are applied beforehand by modules/run_options
+    global state, journal
+    configure(run_args)
+
+    # In incremental mode, results from the previous run are loaded so unchanged buckets can be skipped
+    state = None
+    if args.incremental and not args.objects:
+        state = inc.IncrementalState(os.path.join(args.output_dir, rw.account_name(args, 's3_public_data_state') + '.json.gz'),
+                                      columns, args.max_age, passing)
+
+    # Every checked bucket is journaled as it finishes, so an interrupted run can be continued with --resume
+    journal = None
+    if not args.objects:
+        journal_header = {'columns': columns, 'profile': args.profile, 'region': args.region, 'bucket': args.bucket,
+                          'tag': args.tag}
+        journal = ckp.Journal(os.path.join(args.output_dir, rw.account_name(args, 's3_public_data_journal') + '.jsonl'), journal_header, args.resume)
+
+    # Buckets stream from discovery through evaluation into the report, so each stage is timed as it produces rows
+    all_buckets = mt.timed('s3', 'discovery', get_s3_buckets())
 
-    for bucket in all_buckets:
-        # Populate variables needed to do analysis
-        public_block = get_block_public_access_rules(bucket)
-        bucket_policy = get_bucket_policy(bucket)
-        bucket_acl = get_bucket_acl(bucket)
+    if args.objects:
+        results = mt.timed('s3', 'evaluation', identify_public_objects(all_buckets))
+        with mt.stage('s3', 'report'):
+            path = create_s3_object_report(results)
+        print('S3 objects evaluated successfully. Output file is located at ' + path + '.')
+        return path
 
-        # Create dataframe structures to be converted into CSV
-        append_series = pandas.Series([bucket, public_block, bucket_policy, bucket_acl], index=columns)
-        bucket_df = bucket_df.append(append_series, ignore_index=True)
+    results = mt.timed('s3', 'evaluation', identify_public_buckets(all_buckets))
+    with mt.stage('s3', 'report'):
+        path = create_s3_report(results)
+    print('S3 buckets evaluated successfully. Output file is located at ' + path + '.')
 
-    return bucket_df
+    if state != None:
+        # Only a listing of every bucket shows which buckets are gone
+        complete = args.bucket == None and not args.tag
+        state.save(complete)
+        delta_path = rw.report_path(args, 's3_public_data_delta')
+        changes = state.write_delta(args, 's3_public_data_delta', complete)
+        print(str(state.reused) + ' unchanged bucket(s) reused from the previous run. ' + str(changes) +
+              ' change(s) since the previous run written to ' + delta_path + '.')
 
+    if journal.finish():
+        print(str(journal.failures) + ' bucket(s) could not be evaluated; run again with --resume to retry only those.')
 
-def create_s3_report(results_df):
-    # Uses the results_df from identify_public_buckets function and converts them into the CSV report
-    return results_df.to_csv('./output/s3_public_data.csv', index=False)
+    return path
 
 
 # Main block
-all_buckets = get_s3_buckets()
-results_df = identify_public_buckets(all_buckets)
-create_s3_report(results_df)
-print('S3 buckets evaluated successfully. Output file is located at ./output/s3_public_data.csv.')
+if __name__ == '__main__':
+    options = parser.parse_args()
+    ro.configure(options)
+    run(options)
+    ro.print_summaries()
@@ -1,7 +1,17 @@
 # Import required libraries
 import argparse
-import pandas
+import bisect
+import functools
+import ipaddress
 import modules.build_client as bc
+import modules.discovery as dsc
+import modules.metrics as mt
+import modules.recorder as rec
+import modules.response_cache as rc
+import modules.regions as rg
+import modules.report_writer as rw
+import modules.run_options as ro
+import modules.tags as tg
 from botocore.exceptions import ClientError
 
 # Create argparse object and arguments
@@ -13,84 +23,99 @@ parser.add_argument('-p', '--profile', action='store',
                     help='AWS credential profile to run the script under. Automatically uses "default" if no profile is specified.',
                     required=False, default='default')
 parser.add_argument('-v', '--vpc', action='append',
-                    help='The ID of the single VPC to evaluate. DOES NOT CURRENTLY SUPPORT USING VPC NAME. If no VPC is specified, automatically evaluates all VPCs in the account.',
+                    help='The ID of a VPC to evaluate; can be used more than once. DOES NOT CURRENTLY SUPPORT USING VPC NAME. If no VPC (or --tag) is specified, automatically evaluates all VPCs in the account.',
                     required=False)
+parser.add_argument('--ports', action='store', type=str, default=None,
+                    help='Comma separated TCP ports to check for exposure to the internet, e.g. 22,3389. Defaults to common remote access, file sharing and database ports.',
+                    required=False)
+parser.add_argument('--no-exposure', action='store_true',
+                    help='Skip the security group and network ACL exposure analysis (and its report).',
+                    required=False)
+rg.add_region_arguments(parser)
+tg.add_tag_arguments(parser)
+rc.add_cache_arguments(parser)
+rec.add_recording_arguments(parser)
+rw.add_output_arguments(parser)
+mt.add_metrics_arguments(parser)
+
+# Columns of the CSV report; VPC rows fill the first three columns and subnet rows fill the last two
+columns = ['VPC ID', 'Flow Logs Active', 'Flow Logs Location', 'Subnet ID', 'Subnet Assigns Public IP']
+service = 'ec2'
 
-args = parser.parse_args()
+# Columns of the exposure report; each row is a security group or network ACL that lets the internet reach a sensitive port
+exposure_columns = ['VPC ID', 'Resource Type', 'Resource ID', 'Source', 'Exposed Ports', 'Exposed Subnets',
+                    'Network Interfaces', 'RDS Instances']
 
-# Create required EC2 client to gather VPC data, specifying region
-service = 'ec2'
-print(args.profile)
-print(args.region)
-ec2 = bc.build_client(args.profile, service, args.region)
+# TCP ports checked for exposure by default, and the service usually listening on each
+sensitive_ports = {20: 'FTP data', 21: 'FTP', 22: 'SSH', 23: 'Telnet', 135: 'RPC', 139: 'NetBIOS', 445: 'SMB',
+                   1433: 'SQL Server', 1521: 'Oracle', 2049: 'NFS', 2375: 'Docker', 3306: 'MySQL', 3389: 'RDP',
+                   5432: 'PostgreSQL', 5439: 'Redshift', 5601: 'Kibana', 5900: 'VNC', 6379: 'Redis', 9200: 'Elasticsearch',
+                   11211: 'Memcached', 27017: 'MongoDB'}
 
+# The whole internet for each IP version, as the source network ACL exposures are reported against
+world_networks = {4: ipaddress.ip_network('0.0.0.0/0'), 6: ipaddress.ip_network('::/0')}
 
-# Begin defining functions
-def get_vpcs():
-    # Gathers IDs of all VPCs in the specified region
-    vpc_ids = []
+# The parsed arguments are set by run() (or directly by code importing this script)
+args = None
 
-    try:
-        vpc = ec2.describe_vpcs()
+# The VPCs selected in each region, worked out by get_selected_vpcs() and reset by configure()
+selections = {}
 
-    except ClientError as error:
-        error = error.response['Error']['Code']
-        if error == 'InvalidClientTokenId':
-            print("Error: Invalid Client Token ID. Validate that the token is valid.")
-            exit(1)
-        elif error == 'AccessDenied' or error == 'UnauthorizedOperation':
-            print("Error: Access Denied. See README.md for IAM permissions required to execute this script.")
-            exit(2)
 
-    # Remove unnecessary keys
-    vpc = vpc['Vpcs']
+# Begin defining functions
+def get_selected_vpcs(region):
+    # Determines which VPCs to evaluate in a region from -v and --tag, returning a set of IDs, or None for every VPC
+    # Tagged VPCs are looked up once per region and shared by the VPC audit and the exposure analysis
+    if region not in selections:
+        tagged_vpcs = None
+        if args.tag:
+            tagged_vpcs = tg.get_tagged_ids(args.profile, region, args.tag, ['ec2:vpc'])['ec2:vpc']
 
-    # Grabs the VPC IDs to be used in next steps
-    for value in vpc:
-        vpc_ids.append(value['VpcId'])
+        selections[region] = tg.select(args.vpc, tagged_vpcs)
 
-    # If no VPC is specified in cmd line arguments, evaluate all VPCs in the region
-    if args.vpc is None:
-        print('No VPC specified; evaluating all VPCs in the current region.')
-        print('Discovered VPCs: ' + str(vpc_ids).strip('[]'))
-        return vpc_ids
+    return selections[region]
 
-    # If VPC is specified, check that VPC exists and exit if not
-    elif args.vpc:
-        # Get string of VPC name specified in cmd line argument
-        vpc_specified = args.vpc[0]  # This only works while only one argument is passed in
 
-        if vpc_specified in vpc_ids:
-            return args.vpc
+def get_vpcs(ec2, selected=None):
+    # Gathers IDs of all VPCs in the client's region, yielding them as pages arrive
+    # When VPCs are selected, only those are described, by passing their IDs as a filter
+    vpcs = dsc.paginate_selected(ec2, 'describe_vpcs', 'Vpcs', 'vpc-id', selected)
 
-        elif vpc_specified not in vpc_ids:
+    # If no VPC is specified in cmd line arguments, evaluate all VPCs in the region
+    if selected is None:
+        print('No VPC specified; evaluating all VPCs in the current region.')
+        for vpc in vpcs:
+            print('Discovered VPC: ' + vpc['VpcId'])
+            yield vpc['VpcId']
+        return
+
+    # If VPCs are specified, check that they exist and exit if none do
+    found_vpcs = set()
+    for vpc in vpcs:
+        found_vpcs.add(vpc['VpcId'])
+        yield vpc['VpcId']
+
+    # When several regions are audited, the VPCs only need to exist in one of them
+    missing_vpcs = set(args.vpc or []) - found_vpcs
+    if missing_vpcs and not rg.is_multi_region(args):
+        if not found_vpcs:
             print('ERROR: Specified VPC does not exist in the current AWS account or Region.')
             exit(1)
+        print('WARNING: Specified VPC(s) not found in the current AWS account or Region: ' + ', '.join(sorted(missing_vpcs)) + '.')
 
 
-def gather_subnets(vpc_ids):
-    # Gather all subnets from specified VPC(s)
-    vpc_subnet_dict = {}
+def gather_subnets(ec2, selected=None):
+    # Gather every subnet of the selected VPCs with paginated calls, indexed by the VPC each subnet belongs to
+    subnets = dsc.paginate_selected(ec2, 'describe_subnets', 'Subnets', 'vpc-id', selected)
 
-    for vpc in vpc_ids:
-        subnets = ec2.describe_subnets(Filters=[
-            {
-                'Name': 'vpc-id',
-                'Values': [
-                    vpc,
-                ],
-            },
-        ],
-        )
+    return dsc.index_resources(subnets, 'VpcId')
 
-        # Remove unnecessary keys
-        subnets = subnets['Subnets']
 
-        # Map subnets discovered for the iterated VPC to vpc_subnet_dict variable
-        for dict in subnets:
-            vpc_subnet_dict[str(vpc)] = subnets
+def gather_flow_logs(ec2, selected=None):
+    # Gather every flow log attached to the selected VPCs with paginated calls, indexed by the resource (VPC) it is attached to
+    flow_logs = dsc.paginate_selected(ec2, 'describe_flow_logs', 'FlowLogs', 'resource-id', selected)
 
-    return vpc_subnet_dict
+    return dsc.index_resources(flow_logs, 'ResourceId')
 
 
 def eval_auto_assign_public_subnets(subnet):
@@ -105,25 +130,15 @@ def eval_auto_assign_public_subnets(subnet):
     return auto_public_ip
 
 
-def eval_flow_logs(vpc):
-    # Evaluates current VPC to determine if flow logs are enabled. If logs are enabled, returns their storage location.
-    flow_logs = ec2.describe_flow_logs(Filters=[
-        {
-            'Name': 'resource-id',
-            'Values': [
-                vpc,
-            ],
-        },
-    ],
-    )
-
-    # Remove unnecessary keys
-    flow_logs = flow_logs['FlowLogs']
-
-    # If flow log is inactive, flow_logs['FlowLogs'] returns an empty list
+def eval_flow_logs(flow_logs):
+    # Evaluates the flow logs attached to the current VPC. If logs are enabled, returns their storage location(s).
+    # A VPC can have several flow logs, so every status and destination is reported, separated by semicolons
     if flow_logs:
-        flow_log_active = flow_logs[0]['FlowLogStatus']
-        flow_log_dest = flow_logs[0]['LogDestination']
+        flow_log_active = '; '.join(flow_log['FlowLogStatus'] for flow_log in flow_logs)
+        flow_log_dest = '; '.join(flow_log.get('LogDestination', flow_log.get('LogGroupName', 'N/A'))
+                                  for flow_log in flow_logs)
+
+    # If no flow log is attached, the VPC has no entry in the flow log index
     elif not flow_logs:
         flow_log_active = 'INACTIVE'
         flow_log_dest = 'N/A'
@@ -131,40 +146,349 @@ def eval_flow_logs(vpc):
     return flow_log_active, flow_log_dest
 
 
-def populate_report(vpc_subnet_dict):
-    # Perform VPC evaluations and populate them into DF
-    columns = ['VPC ID', 'Flow Logs Active', 'Flow Logs Location', 'Subnet ID', 'Subnet Assigns Public IP']
-    vpc_df = pandas.DataFrame(columns=list(columns))
+def populate_report(vpc_ids, subnet_index, flow_log_index):
+    # Perform VPC evaluations against the pre-built indexes, yielding report rows as each VPC and subnet is evaluated
+    for vpc_id in vpc_ids:
+        flow_log_active, flow_log_dest = eval_flow_logs(flow_log_index.get(vpc_id, []))
 
-    for vpc in vpc_subnet_dict.values():
-        # Perform subnet evaluations and populate them into DF
-        vpc_id = vpc[0]['VpcId']
-        flow_log_active, flow_log_dest = eval_flow_logs(vpc_id)
+        # Create VPC line to be written into CSV; VPCs without subnets still get their own line
+        yield [vpc_id, flow_log_active, flow_log_dest, '', '']
 
-        # Create dataframe VPC line to be converted into CSV
-        append_series = pandas.Series([vpc_id, flow_log_active, flow_log_dest, '', ''], index=columns)
-        vpc_df = vpc_df.append(append_series, ignore_index=True)
-
-        for subnet in vpc:
-            # Code to evaluate subnet data runs here, then enters data into DF
+        for subnet in subnet_index.get(vpc_id, []):
+            # Code to evaluate subnet data runs here, then is written out as a report line
             auto_public_ip = eval_auto_assign_public_subnets(subnet)
             subnet_id = subnet['SubnetId']
 
-            # Create dataframe subnet line to be converted into CSV
-            append_series = pandas.Series(['', '', '', subnet_id, auto_public_ip], index=columns)
-            vpc_df = vpc_df.append(append_series, ignore_index=True)
+            # Create subnet line to be written into CSV
+            yield ['', '', '', subnet_id, auto_public_ip]
+
+
+def audit_region(region):
+    # Runs the full VPC audit for one region, returning its report rows
+    ec2 = bc.build_client(args.profile, service, region)
+    with mt.stage('vpc', 'discovery'):
+        selected = get_selected_vpcs(region)
+        subnet_index = gather_subnets(ec2, selected)
+        flow_log_index = gather_flow_logs(ec2, selected)
+    vpc_ids = mt.timed('vpc', 'discovery', get_vpcs(ec2, selected))
+
+    return mt.timed('vpc', 'evaluation', populate_report(vpc_ids, subnet_index, flow_log_index))
+
+
+def create_vpc_report(results, report_columns):
+    # Streams the rows from populate_report function into the report as each one is produced, returning its path
+    with rw.open_report(args, 'vpc_audit_data', report_columns) as report:
+        report.write_rows(results)
+
+    return report.path
+
+
+def get_exposure_ports():
+    # The TCP ports checked for exposure, sorted so the ports inside a rule's range can be found by binary search
+    if args.ports == None:
+        return sorted(sensitive_ports)
+
+    try:
+        return sorted(set(int(port) for port in args.ports.split(',') if port.strip()))
+    except ValueError:
+        print('ERROR: --ports must be a comma separated list of port numbers.')
+        exit(4)
+
+
+def ports_in_range(ports, from_port, to_port):
+    # Finds the checked ports inside a rule's port range with two binary searches, so wide ranges such as 0-65535 cost
+    # no more than single ports, and every rule is only looked at once however many there are
+    return ports[bisect.bisect_left(ports, from_port):bisect.bisect_right(ports, to_port)]
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_network(cidr):
+    # Parses a network ACL entry's CIDR, or returns None if it isn't valid; cached for the same reason as world_source
+    try:
+        return ipaddress.ip_network(cidr, strict=False)
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def world_source(cidr):
+    # Returns 0.0.0.0/0 or ::/0 when a CIDR covers every address of its family (however it is written), otherwise None
+    # The same handful of CIDRs appear in most rules, so results are cached rather than parsing every rule's CIDR again
+    try:
+        network = ipaddress.ip_network(cidr, strict=False)
+    except ValueError:
+        return None
+
+    if network.prefixlen != 0:
+        return None
+
+    return str(network)
+
+
+def tcp_port_range(protocol, from_port, to_port):
+    # The TCP ports a security group rule or network ACL entry covers, or None if it doesn't apply to TCP (e.g. UDP, ICMP)
+    if protocol == '-1':
+        return 0, 65535
+
+    if str(protocol).lower() not in ('tcp', '6'):
+        return None
+
+    if from_port == None or from_port == -1:
+        return 0, 65535
+
+    return from_port, to_port
+
+
+def describe_exposure(exposure):
+    # Formats a set of (source, port) pairs as the report's Source and Exposed Ports cells, e.g. 0.0.0.0/0 and 22 (SSH); 3389 (RDP)
+    sources = sorted(set(source for source, port in exposure))
+    ports = sorted(set(port for source, port in exposure))
+
+    return '; '.join(sources), '; '.join(str(port) + (' (' + sensitive_ports[port] + ')' if port in sensitive_ports else '') for port in ports)
+
+
+def security_group_exposures(security_groups, ports):
+    # Finds the security groups with inbound rules that open checked ports to 0.0.0.0/0 or ::/0
+    # Returns {group ID: (group, {(source, port)})}; rules from narrower sources can't expose a port to the whole internet
+    exposures = {}
+
+    for group in security_groups:
+        exposure = set()
+
+        for permission in group.get('IpPermissions', []):
+            port_range = tcp_port_range(permission.get('IpProtocol'), permission.get('FromPort'), permission.get('ToPort'))
+            if port_range == None:
+                continue
+
+            rule_sources = [world_source(ip_range['CidrIp']) for ip_range in permission.get('IpRanges', [])]
+            rule_sources += [world_source(ip_range['CidrIpv6']) for ip_range in permission.get('Ipv6Ranges', [])]
+            rule_sources = [source for source in rule_sources if source != None]
+            if not rule_sources:
+                continue
+
+            for port in ports_in_range(ports, *port_range):
+                exposure.update((source, port) for source in rule_sources)
+
+        if exposure:
+            exposures[group['GroupId']] = (group, exposure)
+
+    return exposures
 
-    return vpc_df
 
+def network_acl_exposure(network_acl, ports):
+    # Works out which checked ports a network ACL lets in from the whole internet, returning a set of (source, port) pairs
+    # Every inbound entry counts, not only those for 0.0.0.0/0 or ::/0, so split ranges (0.0.0.0/1 and 128.0.0.0/1) and
+    # narrower denies in front of a broad allow are weighed too; a port is open when at least half its family is allowed
+    covering = {}
+    entries = sorted((entry for entry in network_acl.get('Entries', []) if not entry.get('Egress')),
+                     key=lambda entry: entry['RuleNumber'])
 
-def create_vpc_report(results_df):
-    # Uses the results_df from function and converts them into the CSV report
-    return results_df.to_csv('./output/vpc_audit_data.csv', index=False)
+    for entry in entries:
+        network = parse_network(entry.get('CidrBlock') or entry.get('Ipv6CidrBlock') or '')
+        port_range = tcp_port_range(entry.get('Protocol'), entry.get('PortRange', {}).get('From'),
+                                    entry.get('PortRange', {}).get('To'))
+        if network == None or port_range == None:
+            continue
+
+        for port in ports_in_range(ports, *port_range):
+            covering.setdefault((network.version, port), []).append((network, entry['RuleAction'] == 'allow'))
+
+    return set((str(world_networks[version]), port) for (version, port), port_entries in covering.items()
+               if allowed_share(world_networks[version], port_entries) >= 0.5)
+
+
+def allowed_share(world, entries):
+    # The share of an address family that (network, is_allowed) entries let in, taking them in rule number order so each
+    # address is decided by the first entry covering it, as AWS does; addresses no entry covers fall to the final deny
+    # remaining holds the undecided addresses as disjoint networks, which any CIDR either contains, sits inside or misses
+    remaining = [world]
+    allowed = 0
+
+    for network, is_allowed in entries:
+        undecided = []
+        for block in remaining:
+            if block.subnet_of(network):
+                decided = block
+            elif network.subnet_of(block):
+                decided = network
+                undecided += block.address_exclude(network)
+            else:
+                undecided.append(block)
+                continue
+
+            if is_allowed:
+                allowed += decided.num_addresses
+
+        remaining = undecided
+        if not remaining:
+            break
+
+    return allowed / world.num_addresses
+
+
+def gather_security_group_usage(ec2, selected, exposed_groups):
+    # Streams every network interface in the selected VPCs once, keeping only those that use an exposed security group
+    # Returns {group ID: [(subnet ID, interface ID)]}, so memory grows with the exposures rather than the estate
+    usage = {}
+    interfaces = dsc.paginate_selected(ec2, 'describe_network_interfaces', 'NetworkInterfaces', 'vpc-id', selected)
+
+    for interface in interfaces:
+        for group in interface.get('Groups', []):
+            if group['GroupId'] in exposed_groups:
+                usage.setdefault(group['GroupId'], []).append((interface.get('SubnetId'), interface['NetworkInterfaceId']))
+
+    return usage
+
+
+def gather_rds_usage(region, selected, exposed_groups):
+    # Finds the RDS instances in the selected VPCs that use an exposed security group, returning {group ID: [instance]}
+    # Returns None when the instances can't be described (e.g. no rds:DescribeDBInstances), so the exposure report is
+    # still written, with the RDS Instances column marked Unknown
+    rds = bc.build_client(args.profile, 'rds', region)
+    usage = {}
+
+    try:
+        for page in dsc.paginate_pages(rds, 'describe_db_instances'):
+            for instance in page.get('DBInstances', []):
+                vpc_id = instance.get('DBSubnetGroup', {}).get('VpcId')
+                if selected != None and vpc_id not in selected:
+                    continue
+
+                for group in instance.get('VpcSecurityGroups', []):
+                    if group['VpcSecurityGroupId'] in exposed_groups:
+                        usage.setdefault(group['VpcSecurityGroupId'], []).append(instance['DBInstanceIdentifier'])
+    except ClientError as error:
+        print('WARNING: Could not describe RDS instances in ' + str(region) + ' (' + error.response['Error']['Code'] +
+              '); RDS instances behind exposed security groups are reported as Unknown.')
+        return None
+
+    return usage
+
+
+def subnet_acl_index(network_acls):
+    # Maps every subnet to its network ACL; subnets without an explicit association use their VPC's default ACL
+    subnet_acls = {}
+    default_acls = {}
+
+    for network_acl in network_acls:
+        if network_acl.get('IsDefault'):
+            default_acls[network_acl['VpcId']] = network_acl['NetworkAclId']
+        for association in network_acl.get('Associations', []):
+            subnet_acls[association['SubnetId']] = network_acl['NetworkAclId']
+
+    return subnet_acls, default_acls
+
+
+def exposure_rows(group_exposures, network_acls, interface_usage, rds_usage, ports):
+    # Maps the rules open to the internet onto the subnets, network interfaces and RDS instances behind them, yielding one
+    # report row per exposed security group or network ACL
+    acl_exposures = {}
+    for network_acl in network_acls:
+        acl_exposures[network_acl['NetworkAclId']] = network_acl_exposure(network_acl, ports)
+    subnet_acls, default_acls = subnet_acl_index(network_acls)
+
+    for group_id, (group, exposure) in group_exposures.items():
+        # A subnet is only exposed when its network ACL also lets the same source in on one of the group's exposed ports
+        exposed_subnets = set()
+        interface_count = 0
+        for subnet_id, interface_id in interface_usage.get(group_id, []):
+            acl_id = subnet_acls.get(subnet_id, default_acls.get(group['VpcId']))
+            if not acl_exposures.get(acl_id, set()).isdisjoint(exposure):
+                exposed_subnets.add(subnet_id)
+                interface_count += 1
+
+        yield [group['VpcId'], 'Security Group', group_id, *describe_exposure(exposure),
+               '; '.join(sorted(exposed_subnets)), interface_count,
+               'Unknown' if rds_usage == None else '; '.join(rds_usage.get(group_id, []))]
+
+    for network_acl in network_acls:
+        exposure = acl_exposures[network_acl['NetworkAclId']]
+        if exposure:
+            subnets = sorted(association['SubnetId'] for association in network_acl.get('Associations', []))
+            yield [network_acl['VpcId'], 'Network ACL', network_acl['NetworkAclId'], *describe_exposure(exposure),
+                   '; '.join(subnets), '', '']
+
+
+def audit_region_exposure(region):
+    # Runs the exposure analysis for one region, returning its report rows
+    # Security groups are streamed straight into the rule checks, so only the exposed groups are held in memory
+    ec2 = bc.build_client(args.profile, service, region)
+    ports = get_exposure_ports()
+
+    with mt.stage('vpc', 'discovery'):
+        selected = get_selected_vpcs(region)
+        network_acls = list(dsc.paginate_selected(ec2, 'describe_network_acls', 'NetworkAcls', 'vpc-id', selected))
+
+    security_groups = mt.timed('vpc', 'discovery',
+                               dsc.paginate_selected(ec2, 'describe_security_groups', 'SecurityGroups', 'vpc-id', selected))
+    with mt.stage('vpc', 'evaluation'):
+        group_exposures = security_group_exposures(security_groups, ports)
+
+    # Network interfaces and RDS instances are only looked up when some security group is exposed
+    interface_usage = {}
+    rds_usage = {}
+    if group_exposures:
+        with mt.stage('vpc', 'discovery'):
+            interface_usage = gather_security_group_usage(ec2, selected, group_exposures)
+            rds_usage = gather_rds_usage(region, selected, group_exposures)
+
+    return mt.timed('vpc', 'evaluation', exposure_rows(group_exposures, network_acls, interface_usage, rds_usage, ports))
+
+
+def create_exposure_report(results, report_columns):
+    # Streams the rows from evaluate_exposure function into the report as each one is produced, returning its path
+    with rw.open_report(args, 'vpc_exposure_data', report_columns) as report:
+        report.write_rows(results)
+
+    return report.path
+
+
+def configure(run_args):
+    # Sets the arguments the functions above use, exiting on invalid --ports; called by run(), and by audit_daemon.py
+    global args, selections
+    args = run_args
+    selections = {}
+    rw.check_format(args.format)
+    get_exposure_ports()
+
+
+def run(run_args):
+    # Runs the VPC audit with arguments parsed by parser, returning the path of the report it wrote
+    # Shared client options (rate limiting, cache, record/replay) are applied beforehand by modules/run_options
+    configure(run_args)
+
+    regions = None
+    if rg.is_multi_region(args):
+        # Regions are audited in parallel and merged into one report with a Region column
+        regions = rg.get_regions(args)
+        print('Evaluating VPCs in regions: ' + ', '.join(regions))
+        results = rg.prefix_region(rg.audit_regions(lambda region: list(audit_region(region)), regions))
+        with mt.stage('vpc', 'report'):
+            path = create_vpc_report(results, ['Region'] + columns)
+    else:
+        results = audit_region(args.region)
+        with mt.stage('vpc', 'report'):
+            path = create_vpc_report(results, columns)
+    print('VPC(s) evaluated successfully. Output file is located at ' + path + '.')
+
+    if not args.no_exposure:
+        if rg.is_multi_region(args):
+            results = rg.prefix_region(rg.audit_regions(lambda region: list(audit_region_exposure(region)), regions))
+            with mt.stage('vpc', 'report'):
+                exposure_path = create_exposure_report(results, ['Region'] + exposure_columns)
+        else:
+            results = audit_region_exposure(args.region)
+            with mt.stage('vpc', 'report'):
+                exposure_path = create_exposure_report(results, exposure_columns)
+        print('Security group and network ACL exposure evaluated successfully. Exposed resources are reported in ' +
+              exposure_path + '.')
+
+    return path
 
 
 # Main block
-vpc_ids = get_vpcs()
-vpc_subnet_dict = gather_subnets(vpc_ids)
-results_df = populate_report(vpc_subnet_dict)
-create_vpc_report(results_df)
-print('VPC(s) evaluated successfully. Output file is located at ./output/vpc_audit_data.csv.')
+if __name__ == '__main__':
+    options = parser.parse_args()
+    ro.configure(options)
+    run(options)
+    ro.print_summaries()
@@ -0,0 +1,210 @@
+# Benchmarks the S3, RDS and VPC audits against a synthetic, in-memory AWS estate
+# Execute `python benchmarks/run_benchmarks.py` from the cloned directory; `-h` gives help details
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3
+import modules.build_client as bc
+from synthetic_estate import SyntheticEstate
+
+parser = argparse.ArgumentParser(description='Benchmark the audit scripts against a synthetic AWS estate (no AWS access needed).')
+parser.add_argument('--buckets', action='store', type=int, default=10000, help='Number of S3 buckets. Defaults to 10000.')
+parser.add_argument('--rds-instances', action='store', type=int, default=5000, help='Number of RDS instances. Defaults to 5000.')
+parser.add_argument('--vpcs', action='store', type=int, default=2000, help='Number of VPCs. Defaults to 2000.')
+parser.add_argument('--subnets', action='store', type=int, default=50000, help='Number of subnets. Defaults to 50000.')
+parser.add_argument('--security-groups', action='store', type=int, default=20000,
+                    help='Number of security groups, with five inbound rules each. Defaults to 20000.')
+parser.add_argument('--latency-ms', action='store', type=float, default=0,
+                    help='Simulated latency added to every API call, in milliseconds. Defaults to 0.')
+parser.add_argument('-c', '--concurrency', action='store', type=int, default=10,
+                    help='Worker threads used by the S3 audit. Defaults to 10.')
+parser.add_argument('-a', '--audits', action='store', type=str, default='s3,rds,vpc',
+                    help='Comma separated audits to benchmark. Defaults to s3,rds,vpc.')
+parser.add_argument('-o', '--output', action='store', type=str, default=None,
+                    help='Where to save the JSON results. Defaults to ./output/benchmarks/benchmark-<timestamp>.json.')
+parser.add_argument('--baseline', action='store', type=str, default=None,
+                    help='Previous JSON results to compare against; exits with status 1 if any stage regressed.')
+parser.add_argument('--tolerance', action='store', type=float, default=0.2,
+                    help='How much slower (or larger) a stage may get before it counts as a regression. Defaults to 0.2 (20%%).')
+
+
+class RssSampler:
+    # Samples the process's resident memory on a background thread to find the peak during a stage
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def current_rss():
+    # Resident memory in bytes; falls back to the lifetime peak where /proc is unavailable
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def measure(results, estate, name, function):
+    # Runs one stage, recording wall-clock time, API calls, requests per second and peak RSS
+    calls_before = estate.calls
+
+    # The audits' own progress messages are discarded so they don't skew the timings
+    with RssSampler() as sampler, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        value = function()
+        seconds = time.perf_counter() - started
+
+    api_calls = estate.calls - calls_before
+    results.append({'stage': name, 'seconds': round(seconds, 4), 'api_calls': api_calls,
+                    'requests_per_second': round(api_calls / seconds, 1) if seconds and api_calls else 0,
+                    'peak_rss_mb': round(sampler.peak / 1048576, 1)})
+    print('{:<32} {:>9.3f}s {:>9} calls {:>10.1f} req/s {:>8.1f} MB'.format(
+        name, seconds, api_calls, results[-1]['requests_per_second'], results[-1]['peak_rss_mb']))
+
+    return value
+
+
+def benchmark_s3(results, estate, args, output_dir):
+    import audit_s3
+
+    audit_s3.args = audit_s3.parser.parse_args(['-c', str(args.concurrency)])
+    audit_s3.s3 = bc.build_client('benchmark', 's3', None, max_pool_connections=args.concurrency)
+    os.chdir(output_dir)
+
+    buckets = measure(results, estate, 's3.discovery', lambda: list(audit_s3.get_s3_buckets()))
+    rows = measure(results, estate, 's3.identify_public_buckets', lambda: list(audit_s3.identify_public_buckets(buckets)))
+    measure(results, estate, 's3.report', lambda: audit_s3.create_s3_report(rows))
+
+
+def benchmark_rds(results, estate, args, output_dir):
+    import audit_rds
+    # audit_rds imports pandas on first use; importing it here keeps that one-off cost out of the measured stages
+    import pandas
+
+    audit_rds.args = audit_rds.parser.parse_args([])
+    rds = bc.build_client('benchmark', 'rds', None)
+    os.chdir(output_dir)
+
+    instances = measure(results, estate, 'rds.discovery', lambda: list(audit_rds.get_rds_instances(rds, None)))
+    df = measure(results, estate, 'rds.create_rds_df', lambda: audit_rds.run_checks(instances))
+    measure(results, estate, 'rds.report', lambda: audit_rds.create_rds_report(df))
+
+
+def benchmark_vpc(results, estate, args, output_dir):
+    import audit_vpc
+
+    audit_vpc.args = audit_vpc.parser.parse_args(['-p', 'benchmark'])
+    ec2 = bc.build_client('benchmark', 'ec2', None)
+    os.chdir(output_dir)
+
+    def discover():
+        return list(audit_vpc.get_vpcs(ec2)), audit_vpc.gather_subnets(ec2), audit_vpc.gather_flow_logs(ec2)
+
+    vpc_ids, subnet_index, flow_log_index = measure(results, estate, 'vpc.discovery', discover)
+    rows = measure(results, estate, 'vpc.populate_report',
+                   lambda: list(audit_vpc.populate_report(vpc_ids, subnet_index, flow_log_index)))
+    measure(results, estate, 'vpc.report', lambda: audit_vpc.create_vpc_report(rows, audit_vpc.columns))
+
+    # Loads every security group, network ACL and network interface, then checks each rule for internet exposure
+    measure(results, estate, 'vpc.exposure', lambda: list(audit_vpc.audit_region_exposure(None)))
+
+
+def compare(results, baseline_path, tolerance):
+    # Compares each stage with the baseline run, returning the stages that got slower, larger or chattier
+    with open(baseline_path) as file:
+        baseline = {stage['stage']: stage for stage in json.load(file)['stages']}
+
+    regressions = []
+    for stage in results:
+        previous = baseline.get(stage['stage'])
+        if previous == None:
+            continue
+
+        for metric in ['seconds', 'api_calls', 'peak_rss_mb']:
+            # Very short stages are too noisy to compare on time alone
+            if metric == 'seconds' and previous[metric] < 0.05:
+                continue
+            if stage[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(stage['stage'] + ' ' + metric + ': ' + str(previous[metric]) + ' -> ' + str(stage[metric]))
+
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    estate = SyntheticEstate(args.buckets, args.rds_instances, args.vpcs, args.subnets, args.security_groups, args.latency_ms)
+
+    # Clients never reach AWS: they use placeholder credentials and every call is answered by the synthetic estate
+    bc.offline_session = boto3.session.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark',
+                                               region_name='us-east-1')
+    bc.register_client_hook(estate.register)
+
+    output_path = os.path.abspath(args.output or './output/benchmarks/benchmark-' +
+                                  datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    baseline_path = os.path.abspath(args.baseline) if args.baseline != None else None
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    results = []
+    benchmarks = {'s3': benchmark_s3, 'rds': benchmark_rds, 'vpc': benchmark_vpc}
+
+    # Reports are written to a scratch directory so benchmarking never overwrites real audit output
+    with tempfile.TemporaryDirectory() as scratch:
+        os.makedirs(os.path.join(scratch, 'output'))
+        working_dir = os.getcwd()
+        try:
+            for audit in args.audits.split(','):
+                benchmarks[audit.strip()](results, estate, args, scratch)
+        finally:
+            os.chdir(working_dir)
+
+    summary = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'buckets': args.buckets, 'rds_instances': args.rds_instances, 'vpcs': args.vpcs,
+                       'subnets': args.subnets, 'security_groups': args.security_groups, 'latency_ms': args.latency_ms, 'concurrency': args.concurrency},
+        'stages': results,
+    }
+    with open(output_path, 'w') as file:
+        json.dump(summary, file, indent=2)
+    print('Benchmark results saved to ' + output_path)
+
+    if baseline_path != None:
+        regressions = compare(results, baseline_path, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            exit(1)
+        print('No regressions against ' + baseline_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import datetime
+import threading
+import time
+from botocore.awsrequest import AWSResponse
+
+# A stubbed AWS estate for benchmarking: every call made through a registered client is answered in memory
+# Responses are generated from the resource's index on demand, so even 100k buckets cost almost no memory to set up
+
+all_users_uri = 'http://acs.amazonaws.com/groups/global/AllUsers'
+created = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class SyntheticEstate:
+
+    def __init__(self, buckets=10000, rds_instances=5000, vpcs=2000, subnets=50000, security_groups=20000, latency_ms=0):
+        self.buckets = buckets
+        self.rds_instances = rds_instances
+        self.vpcs = vpcs
+        self.subnets = subnets
+        self.security_groups = security_groups
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def register(self, client):
+        # Attaches the estate to a client; intended for modules/build_client.register_client_hook
+        client.meta.events.register('before-parameter-build', self.capture_params, unique_id='synthetic-params')
+        client.meta.events.register_last('before-call', self.answer, unique_id='synthetic-answer')
+
+    def capture_params(self, params, context, **kwargs):
+        context['synthetic_params'] = dict(params)
+
+    def answer(self, model, context, **kwargs):
+        # Builds the response for a call, optionally sleeping to simulate network latency
+        with self.lock:
+            self.calls += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = getattr(self, model.name, None)
+        status, parsed = handler(context.get('synthetic_params', {})) if handler != None else (200, {})
+        parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': status})
+
+        return AWSResponse(model.name, status, {}, None), parsed
+
+    def page(self, key, count, build, params, token_name, page_size):
+        # Returns one page of generated resources, with a continuation token when more remain
+        start = int(params.get(token_name) or 0)
+        end = min(count, start + page_size)
+        response = {key: [build(index) for index in range(start, end)]}
+
+        if end < count:
+            response[token_name] = str(end)
+
+        return 200, response
+
+    # S3: every 10th bucket has no public access block, every 25th has a public policy and every 50th a public ACL
+    def ListBuckets(self, params):
+        return self.page('Buckets', self.buckets,
+                         lambda index: {'Name': 'bucket-%06d' % index, 'CreationDate': created, 'BucketRegion': 'us-east-1'},
+                         params, 'ContinuationToken', 1000)
+
+    def GetPublicAccessBlock(self, params):
+        index = int(params['Bucket'].split('-')[1])
+        if index % 10 == 0:
+            return 404, {'Error': {'Code': 'NoSuchPublicAccessBlockConfiguration', 'Message': ''}}
+
+        return 200, {'PublicAccessBlockConfiguration': {'BlockPublicAcls': True, 'IgnorePublicAcls': True,
+                                                        'BlockPublicPolicy': True, 'RestrictPublicBuckets': index % 3 != 0}}
+
+    def GetBucketPolicyStatus(self, params):
+        index = int(params['Bucket'].split('-')[1])
+        if index % 4 == 0:
+            return 404, {'Error': {'Code': 'NoSuchBucketPolicy', 'Message': ''}}
+
+        return 200, {'PolicyStatus': {'IsPublic': index % 25 == 0}}
+
+    def GetBucketAcl(self, params):
+        index = int(params['Bucket'].split('-')[1])
+        grants = [{'Grantee': {'Type': 'CanonicalUser', 'ID': 'owner'}, 'Permission': 'FULL_CONTROL'}]
+        if index % 50 == 0:
+            grants.append({'Grantee': {'Type': 'Group', 'URI': all_users_uri}, 'Permission': 'READ'})
+
+        return 200, {'Owner': {'ID': 'owner'}, 'Grants': grants}
+
+    def GetBucketLocation(self, params):
+        return 200, {'LocationConstraint': None}
+
+    # RDS
+    def DescribeDBInstances(self, params):
+        return self.page('DBInstances', self.rds_instances, self.db_instance, params, 'Marker', 100)
+
+    def db_instance(self, index):
+        return {'DBInstanceIdentifier': 'db-%05d' % index, 'DBInstanceArn': 'arn:aws:rds:us-east-1:123456789012:db:db-%05d' % index,
+                'Engine': ['postgres', 'mysql', 'aurora-postgresql'][index % 3], 'DBInstanceStatus': 'available',
+                'InstanceCreateTime': created, 'BackupRetentionPeriod': index % 14, 'MultiAZ': index % 2 == 0,
+                'ReadReplicaDBInstanceIdentifiers': [], 'DeletionProtection': index % 5 != 0,
+                'PubliclyAccessible': index % 20 == 0, 'StorageEncrypted': index % 7 != 0,
+                'DBSubnetGroup': {'VpcId': 'vpc-%05d' % (index % 500 % self.vpcs)},
+                'IAMDatabaseAuthenticationEnabled': False, 'AssociatedRoles': [],
+                'VpcSecurityGroups': [{'VpcSecurityGroupId': 'sg-%05d' % (index % 500), 'Status': 'active'}],
+                'MonitoringInterval': [0, 1, 5, 60][index % 4], 'PerformanceInsightsEnabled': index % 2 == 1,
+                'EnabledCloudwatchLogsExports': ['postgresql'] if index % 3 == 0 else []}
+
+    # EC2 / VPC: subnets are spread evenly over the VPCs, and every other VPC has a flow log
+    def DescribeVpcs(self, params):
+        return self.page('Vpcs', self.vpcs, lambda index: {'VpcId': 'vpc-%05d' % index, 'IsDefault': index == 0},
+                         params, 'NextToken', 1000)
+
+    def DescribeSubnets(self, params):
+        return self.page('Subnets', self.subnets,
+                         lambda index: {'SubnetId': 'subnet-%06d' % index, 'VpcId': 'vpc-%05d' % (index % self.vpcs),
+                                        'MapPublicIpOnLaunch': index % 3 == 0}, params, 'NextToken', 1000)
+
+    def DescribeFlowLogs(self, params):
+        return self.page('FlowLogs', (self.vpcs + 1) // 2,
+                         lambda index: {'FlowLogId': 'fl-%05d' % index, 'ResourceId': 'vpc-%05d' % (index * 2),
+                                        'FlowLogStatus': 'ACTIVE', 'LogDestination': 'arn:aws:s3:::flow-logs'},
+                         params, 'NextToken', 1000)
+
+    # Security groups have five inbound rules each; every 100th group opens SSH to 0.0.0.0/0 and every 250th opens
+    # everything to ::/0. Each VPC has a default network ACL allowing all traffic, and each subnet one network interface
+    def DescribeSecurityGroups(self, params):
+        return self.page('SecurityGroups', self.security_groups, self.security_group, params, 'NextToken', 1000)
+
+    def security_group(self, index):
+        rules = [{'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'Ipv6Ranges': []},
+                 {'IpProtocol': 'tcp', 'FromPort': 0, 'ToPort': 65535, 'IpRanges': [{'CidrIp': '10.0.0.0/8'}], 'Ipv6Ranges': []},
+                 {'IpProtocol': 'udp', 'FromPort': 53, 'ToPort': 53, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'Ipv6Ranges': []},
+                 {'IpProtocol': 'tcp', 'FromPort': 5432, 'ToPort': 5432, 'IpRanges': [{'CidrIp': '172.16.0.0/12'}], 'Ipv6Ranges': []},
+                 {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22,
+                  'IpRanges': [{'CidrIp': '0.0.0.0/0' if index % 100 == 0 else '192.168.0.0/16'}], 'Ipv6Ranges': []}]
+        if index % 250 == 0:
+            rules.append({'IpProtocol': '-1', 'IpRanges': [], 'Ipv6Ranges': [{'CidrIpv6': '::/0'}]})
+
+        return {'GroupId': 'sg-%05d' % index, 'VpcId': 'vpc-%05d' % (index % self.vpcs), 'IpPermissions': rules}
+
+    def DescribeNetworkAcls(self, params):
+        entries = [{'RuleNumber': 100, 'Protocol': '-1', 'RuleAction': 'allow', 'Egress': False, 'CidrBlock': '0.0.0.0/0'},
+                   {'RuleNumber': 101, 'Protocol': '-1', 'RuleAction': 'allow', 'Egress': False, 'Ipv6CidrBlock': '::/0'},
+                   {'RuleNumber': 32767, 'Protocol': '-1', 'RuleAction': 'deny', 'Egress': False, 'CidrBlock': '0.0.0.0/0'}]
+        return self.page('NetworkAcls', self.vpcs,
+                         lambda index: {'NetworkAclId': 'acl-%05d' % index, 'VpcId': 'vpc-%05d' % index, 'IsDefault': True,
+                                        'Entries': entries, 'Associations': []}, params, 'NextToken', 1000)
+
+    def DescribeNetworkInterfaces(self, params):
+        return self.page('NetworkInterfaces', self.subnets,
+                         lambda index: {'NetworkInterfaceId': 'eni-%06d' % index, 'SubnetId': 'subnet-%06d' % index,
+                                        'VpcId': 'vpc-%05d' % (index % self.vpcs),
+                                        'Groups': [{'GroupId': 'sg-%05d' % (index % self.security_groups)}]},
+                         params, 'NextToken', 1000)
+
+    def DescribeRegions(self, params):
+        return 200, {'Regions': [{'RegionName': 'us-east-1'}]}
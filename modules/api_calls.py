@@ -0,0 +1,59 @@
+import base64
+import datetime
+import json
+
+# Helpers shared by the modules that look at individual API calls (response cache, record/replay, etc.)
+
+
+def capture_params(params, context, **kwargs):
+    # Keeps a copy of the caller's API parameters in the request context, since later events only see the serialised request
+    context['audit_api_params'] = dict(params)
+
+
+def register(client):
+    # Attaches the parameter capture to a client; safe to call more than once
+    client.meta.events.register('before-parameter-build', capture_params, unique_id='audit-capture-params')
+
+
+def call_details(model, context):
+    # Returns the (service, region, operation, params) of the call a before-call/after-call event belongs to
+    return (model.service_model.service_name, context.get('client_region'), model.name,
+            context.get('audit_api_params', {}))
+
+
+def call_key(*parts):
+    # Builds a stable string key from the identifying parts of an API call, whatever order the parameters were passed in
+    return json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+
+
+def is_read_only(operation):
+    # describe/list/get calls can be cached or replayed safely; anything else changes state
+    return operation.startswith(('Describe', 'List', 'Get', 'Head'))
+
+
+def encode(value):
+    # Converts a parsed response into JSON-safe values, tagging the types JSON cannot represent
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+
+    return value
+
+
+def decode(value):
+    # Reverses encode(), restoring datetimes and bytes
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.datetime.fromisoformat(value['__datetime__'])
+        if '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        return {key: decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+
+    return value
@@ -1,19 +1,92 @@
+import threading
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ProfileNotFound, NoCredentialsError, NoRegionError
 
+# botocore settings used for every client; tuned for many concurrent calls rather than the defaults of
+# a 10 connection pool and legacy retries
+default_config = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=10,
+    read_timeout=60,
+    tcp_keepalive=True,
+)
+
+# Sessions are cached per profile, and clients per (profile, region, service, config), so credentials are only
+# resolved once and connections are reused across every call and worker thread
+sessions = {}
+clients = {}
+# The profile (or session name) each client was built for, so client hooks can tell accounts apart in organization runs
+client_profiles = {}
+cache_lock = threading.RLock()
+
+# Session used in place of the profile's when running offline (e.g. replaying a recorded run)
+offline_session = None
+
+# Functions called with every newly created client, used by other modules to register botocore event handlers
+client_hooks = []
+
+
+def build_config(max_pool_connections=None, config=None):
+    # Combines the default settings with a connection pool size and/or any caller specific botocore Config
+    client_config = default_config
+
+    if max_pool_connections != None:
+        client_config = client_config.merge(Config(max_pool_connections=int(max_pool_connections)))
+
+    if config != None:
+        client_config = client_config.merge(config)
+
+    return client_config
+
+
+def register_client_hook(hook):
+    # Registers a function to be called with each new client; clients that already exist are passed to it straight away
+    with cache_lock:
+        if hook in client_hooks:
+            return
+
+        client_hooks.append(hook)
+        for client in clients.values():
+            hook(client)
+
+
+def get_session(profile):
+    # Returns the cached Boto3 session for a profile, creating it the first time it is asked for
+    profile = str(profile)
+
+    if offline_session != None:
+        return offline_session
+
+    with cache_lock:
+        if profile not in sessions:
+            sessions[profile] = boto3.session.Session(profile_name=profile)
+
+        return sessions[profile]
+
+
+def add_session(name, session):
+    # Registers a session built elsewhere (e.g. from assumed role credentials) under a name that can be used in place of a profile
+    with cache_lock:
+        sessions.setdefault(str(name), session)
+
+
+def build_client(profile, service, region, max_pool_connections=None, config=None):
+    # Builds (or reuses) a Boto3 client to connect to AWS based on how profile is set up, and what cmd line arguments are passed
+    # When region is None, the region specified in the profile is used
+    # When max_pool_connections is set, the client's HTTP connection pool is sized to match the number of worker threads
+    # Boto3 clients are thread safe, so the same client is handed to every worker thread that asks for it
+    key = (str(profile), region, str(service), max_pool_connections, config)
+
+    with cache_lock:
+        if key in clients:
+            return clients[key]
 
-def build_client(profile, service, region):
-    # Builds Boto3 client to connect to AWS based on how profile is set up, and what cmd line arguments are passed
-    if region == None:
         try:
-            if profile == 'default':
-                session = boto3.session.Session(profile_name='default')
-                client = session.client(str(service))
-                return client
-            else:
-                session = boto3.session.Session(profile_name=str(profile))
-                client = session.client(str(service))
-                return client
+            session = get_session(profile)
+            client = session.client(str(service), region_name=region,
+                                    config=build_config(max_pool_connections, config))
         except ProfileNotFound:
             print(
                 "Error: Profile Not Found. Please check your typing and ensure the profile is located in your ~/.aws folder.")
@@ -25,20 +98,10 @@ def build_client(profile, service, region):
             print("Error: No Region Found. Please ensure the selected (or default) profile has a region specified.")
             exit(3)
 
-    elif region != None:
-        try:
-            if profile == 'default':
-                session = boto3.session.Session(profile_name='default', region_name=region)
-                client = session.client(str(service))
-                return client
-            elif profile is type(str):
-                session = boto3.session.Session(profile_name=str(profile), region_name=region)
-                client = session.client(str(service))
-                return client
-        except ProfileNotFound:
-            print(
-                "Error: Profile Not Found. Please check your typing and ensure the profile is located in your ~/.aws folder.")
-            exit(1)
-        except NoCredentialsError:
-            print("Error: Credentials Not Found. Please ensure your ~/.aws/credentials file is set up correctly.")
-            exit(2)
+        client_profiles[client] = str(profile)
+        for hook in client_hooks:
+            hook(client)
+
+        clients[key] = client
+
+        return client
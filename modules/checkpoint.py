@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+import modules.api_calls as api
+
+# How often appended results are forced to disk, in seconds; each line is flushed to the OS as soon as it is written
+sync_interval = 1.0
+
+
+def add_checkpoint_arguments(parser):
+    # Adds the resume argument shared by the audit scripts that keep a progress journal
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its progress journal in the output directory, only checking resources that were not finished (or failed) before it stopped.',
+                        required=False)
+
+
+class Journal:
+    # Appends each resource's result to a JSON lines file as soon as it is checked, so an interrupted run can pick up where it stopped
+    # The first line describes the run (columns and the options that decide what is checked); a resumed run only reuses
+    # a journal written with the same description
+
+    def __init__(self, path, header, resume):
+        self.path = path
+        self.header = header
+        self.completed = {}
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.last_sync = time.monotonic()
+        self.valid_length = 0
+
+        if resume:
+            self.completed = self.load()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if self.completed:
+            print(str(len(self.completed)) + ' resource(s) already checked, resuming from ' + path + '.')
+            # Anything after the last complete line is cut off, so new results don't get appended to a half written one
+            os.truncate(path, self.valid_length)
+            self.file = open(path, 'a')
+        else:
+            self.file = open(path, 'w')
+            self.write_line({'header': header})
+
+    def load(self):
+        # Reads the results of the interrupted run; a half written last line (e.g. from a killed process) is ignored
+        completed = {}
+
+        try:
+            with open(self.path, newline='') as file:
+                lines = iter(file)
+                first_line = next(lines, None)
+                if first_line == None or json.loads(first_line).get('header') != self.header:
+                    print('WARNING: ' + self.path + ' was written by a run with different options; starting from the beginning.')
+                    return {}
+                self.valid_length = len(first_line.encode())
+
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith('\n'):
+                        break
+                    completed[entry['id']] = api.decode(entry['row'])
+                    self.valid_length += len(line.encode())
+        except FileNotFoundError:
+            print('No progress journal found at ' + self.path + '; starting from the beginning.')
+        except ValueError:
+            print('WARNING: ' + self.path + ' could not be read; starting from the beginning.')
+            return {}
+
+        return completed
+
+    def write_line(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+            self.file.flush()
+
+            if time.monotonic() - self.last_sync >= sync_interval:
+                os.fsync(self.file.fileno())
+                self.last_sync = time.monotonic()
+
+    def completed_row(self, resource_id):
+        # Returns the journaled result of a resource finished before the run was interrupted, or None if it still needs checking
+        return self.completed.get(resource_id)
+
+    def record(self, resource_id, row):
+        # Appends a finished resource's result; called from the worker threads as each resource completes
+        self.write_line({'id': resource_id, 'row': api.encode(list(row))})
+
+    def record_failure(self, resource_id):
+        # Failed resources are not journaled, so a resumed run checks them again
+        with self.lock:
+            self.failures += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def finish(self):
+        # Closes the journal once the report is written; it is only kept if some resources failed, so they can be retried with --resume
+        self.close()
+
+        if self.failures == 0:
+            os.remove(self.path)
+            return False
+
+        return True
@@ -0,0 +1,77 @@
+from botocore.exceptions import ClientError
+import modules.worker_pool as wp
+
+
+def paginate(client, operation, result_key, prefetch_pages=1, **kwargs):
+    # Yields resources from a describe/list call one at a time, following Marker/NextToken through every page
+    # Pages are fetched on a background thread, so callers can start evaluating page one while page two is in flight
+    try:
+        for page in paginate_pages(client, operation, prefetch_pages, **kwargs):
+            for resource in page.get(result_key, []):
+                yield resource
+
+    except ClientError as error:
+        handle_discovery_error(error)
+
+
+def paginate_pages(client, operation, prefetch_pages=1, **kwargs):
+    # Yields whole pages of a describe/list call, for callers that read more than one key of each page
+    # Errors are raised to the caller rather than exiting, so worker threads can report them against the resource they were listing
+    if client.can_paginate(operation):
+        pages = client.get_paginator(operation).paginate(**kwargs)
+    else:
+        pages = single_page(client, operation, kwargs)
+
+    yield from prefetch(pages, prefetch_pages)
+
+
+def paginate_selected(client, operation, result_key, filter_name, selected, chunk_size=100, **kwargs):
+    # Yields only the selected resources (a set of IDs, or None for every resource), filtering by ID on the server
+    # Filters take a limited number of values, so the IDs are sent in chunks; an empty selection makes no calls at all
+    if selected == None:
+        yield from paginate(client, operation, result_key, **kwargs)
+        return
+
+    ids = sorted(selected)
+    for start in range(0, len(ids), chunk_size):
+        filters = [{'Name': filter_name, 'Values': ids[start:start + chunk_size]}]
+        yield from paginate(client, operation, result_key, Filters=filters, **kwargs)
+
+
+def index_resources(resources, key):
+    # Groups resources by one of their fields (e.g. VpcId), so per-resource checks become dictionary lookups
+    # rather than one API call per resource
+    index = {}
+
+    for resource in resources:
+        index.setdefault(resource.get(key), []).append(resource)
+
+    return index
+
+
+def single_page(client, operation, kwargs):
+    # Wraps operations that have no paginator so they can be consumed the same way
+    yield getattr(client, operation)(**kwargs)
+
+
+def prefetch(pages, prefetch_pages):
+    # Pulls pages on a background thread, keeping at most prefetch_pages pages waiting ahead of the consumer
+    # This is modules/worker_pool's interleave with a single iterable, so errors and an early stop are handled the same way
+    if prefetch_pages < 1:
+        yield from pages
+        return
+
+    yield from wp.interleave([pages], 1, buffer_size=prefetch_pages)
+
+
+def handle_discovery_error(error):
+    # Exits with the same messages the scripts have always used for credential and permission problems
+    code = error.response['Error']['Code']
+    if code == 'InvalidClientTokenId':
+        print("Error: Invalid Client Token ID. Validate that the token is valid.")
+        exit(1)
+    elif code == 'AccessDenied' or code == 'UnauthorizedOperation':
+        print("Error: Access Denied. See README.md for IAM permissions required to execute this script.")
+        exit(2)
+
+    raise error
@@ -0,0 +1,151 @@
+import glob
+import json
+import os
+import time
+import urllib.parse
+import modules.build_client as bc
+
+
+def add_event_arguments(parser):
+    # Adds the arguments choosing where audit_daemon.py reads change events from
+    parser.add_argument('--events', action='store', type=str, required=True, metavar='SOURCE',
+                        help='Where change events are read from: the URL of an SQS queue (e.g. the target of an EventBridge rule matching CloudTrail API calls), or a JSON lines file or directory of *.jsonl files for testing. Each message is an EventBridge event, the same event delivered through SNS, a CloudTrail log file or a single CloudTrail record.')
+    parser.add_argument('--poll-interval', action='store', type=float, default=1.0,
+                        help='With a file or directory, how often (in seconds) it is checked for new lines. Defaults to 1.',
+                        required=False)
+
+
+def open_source(args):
+    # Opens the event source named by --events; queue URLs are read from SQS and anything else is treated as a local path
+    if urllib.parse.urlparse(args.events).scheme in ('http', 'https'):
+        return SqsEventSource(args.profile, args.events)
+
+    if not os.path.exists(args.events):
+        print('ERROR: Event file or directory ' + args.events + ' does not exist.')
+        exit(4)
+
+    return FileEventSource(args.events, args.poll_interval)
+
+
+def cloudtrail_records(message):
+    # Unwraps the CloudTrail records carried by one message: an EventBridge event ("AWS API Call via CloudTrail"),
+    # the same event delivered through SNS, a CloudTrail log file ({"Records": [...]}) or a bare record
+    if isinstance(message, str):
+        message = json.loads(message)
+
+    if message.get('Type') == 'Notification' and 'Message' in message:
+        return cloudtrail_records(message['Message'])
+    if isinstance(message.get('detail'), dict):
+        return [message['detail']]
+    if isinstance(message.get('Records'), list):
+        return message['Records']
+
+    return [message]
+
+
+def read_message(body, origin):
+    # Parses one message, warning about (and skipping) anything that isn't JSON rather than stopping the daemon
+    try:
+        return cloudtrail_records(body)
+    except (ValueError, AttributeError) as error:
+        print('WARNING: Skipping unreadable event from ' + origin + ' (' + type(error).__name__ + ').')
+        return []
+
+
+def queue_region(queue_url):
+    # The region of an SQS queue, from its URL: https://sqs.us-east-1.amazonaws.com/... or https://us-east-1.queue.amazonaws.com/...
+    host = urllib.parse.urlparse(queue_url).netloc.split('.')
+
+    return host[1] if host[0] == 'sqs' else host[0]
+
+
+class FileEventSource:
+    # Reads events from a JSON lines file, or from every *.jsonl file in a directory in name order, then keeps following them
+    # for lines appended later (and, for a directory, new files), like tail -f; meant for testing and replaying captured events
+    # Only complete lines are read, so a line still being written is picked up once it is finished
+
+    def __init__(self, path, poll_interval):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.offsets = {}
+
+    def files(self):
+        if os.path.isdir(self.path):
+            return sorted(glob.glob(os.path.join(self.path, '*.jsonl')))
+
+        return [self.path]
+
+    def read_file(self, path):
+        # Returns the records on lines added to a file since it was last read
+        records = []
+        offset = self.offsets.get(path, 0)
+
+        # A file that shrank has been truncated or replaced, so it is read again from the start
+        if os.path.getsize(path) < offset:
+            offset = 0
+
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            for line in file:
+                # A last line without a newline is only taken once it parses, as it may still be being written
+                if not line.endswith(b'\n'):
+                    try:
+                        json.loads(line)
+                    except ValueError:
+                        break
+
+                offset += len(line)
+                if line.strip():
+                    records += read_message(line.decode(), path)
+
+        self.offsets[path] = offset
+
+        return records
+
+    def poll(self, timeout):
+        # Returns the records added since the last poll, sleeping for the poll interval (at most timeout) when there are none
+        records = []
+        for path in self.files():
+            if os.path.isfile(path):
+                records += self.read_file(path)
+
+        if not records:
+            time.sleep(max(0, min(timeout, self.poll_interval)))
+
+        return records
+
+    def acknowledge(self):
+        # Lines are never read twice, so there is nothing to confirm
+        pass
+
+
+class SqsEventSource:
+    # Receives events from an SQS queue with long polling, up to 10 messages per call
+    # Messages are only deleted by acknowledge(), once their records have been handled, so events received by a daemon that
+    # stops part way are delivered again after the queue's visibility timeout
+
+    def __init__(self, profile, queue_url):
+        self.queue_url = queue_url
+        self.sqs = bc.build_client(profile, 'sqs', queue_region(queue_url))
+        self.receipts = []
+
+    def poll(self, timeout):
+        # Waits up to timeout seconds (at most 20, SQS's longest wait) for messages, returning the records they carry
+        response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                            WaitTimeSeconds=int(max(0, min(timeout, 20))))
+
+        records = []
+        for message in response.get('Messages', []):
+            self.receipts.append(message['ReceiptHandle'])
+            records += read_message(message['Body'], 'message ' + message['MessageId'])
+
+        return records
+
+    def acknowledge(self):
+        # Deletes the messages received so far, 10 per call; unreadable messages are deleted too, so they aren't received forever
+        for start in range(0, len(self.receipts), 10):
+            entries = [{'Id': str(index), 'ReceiptHandle': receipt}
+                       for index, receipt in enumerate(self.receipts[start:start + 10])]
+            self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+        self.receipts = []
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import modules.api_calls as api
+import modules.report_writer as rw
+
+
+def add_incremental_arguments(parser):
+    # Adds the incremental mode arguments shared by the audit scripts that support it
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only re-check resources that changed since the last incremental run, and write a delta report of new, resolved and changed findings.',
+                        required=False)
+    parser.add_argument('--max-age', action='store', type=float, default=7,
+                        help='In incremental mode, re-check unchanged resources anyway once their last check is older than this many days. Defaults to 7.',
+                        required=False)
+
+
+def fingerprint(*values):
+    # Hashes the cheap signals that tell whether a resource changed (creation date, status, etc.)
+    return hashlib.sha256(api.call_key(*api.encode(list(values))).encode()).hexdigest()
+
+
+class IncrementalState:
+    # Results and fingerprints from the previous run, plus those gathered during this one
+    # Stored in the output directory (at path) so the next run can skip resources that have not changed
+    # passing maps each check column to the value it has when the check passes; any other value in that column is a finding
+
+    def __init__(self, path, columns, max_age_days, passing):
+        self.path = path
+        self.columns = list(columns)
+        self.max_age = max_age_days * 86400
+        self.passing = passing
+        self.previous = {}
+        self.current = {}
+        self.reused = 0
+        self.lock = threading.Lock()
+
+        try:
+            with gzip.open(self.path, 'rt') as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = None
+
+        # Results are only comparable when the previous run produced the same columns
+        if state != None and state['columns'] == self.columns:
+            self.previous = state['resources']
+
+    def unchanged_row(self, resource_id, resource_fingerprint):
+        # Returns the previous row for a resource whose fingerprint still matches and whose check is recent enough
+        # Returns None when the resource has to be evaluated again
+        entry = self.previous.get(resource_id)
+
+        if entry == None or entry['fingerprint'] != resource_fingerprint:
+            return None
+        if time.time() - entry['checked_at'] > self.max_age:
+            return None
+
+        with self.lock:
+            self.current[resource_id] = entry
+            self.reused += 1
+
+        return api.decode(entry['row'])
+
+    def record(self, resource_id, resource_fingerprint, row):
+        # Stores the result of a fresh check; pass a fingerprint of None for failed checks so they are retried next time
+        with self.lock:
+            self.current[resource_id] = {'fingerprint': resource_fingerprint, 'checked_at': time.time(),
+                                         'row': api.encode(list(row))}
+
+    def save(self, complete):
+        # Replaces the stored state with the results of this run
+        # Unless the run listed every resource (no -b/-i/--tag scope and no failed region), resources it didn't see keep
+        # their previous results, as they may well still exist
+        resources = dict(self.current)
+        if not complete:
+            for resource_id, entry in self.previous.items():
+                resources.setdefault(resource_id, entry)
+
+        temp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with gzip.open(temp_path, 'wt') as file:
+            json.dump({'columns': self.columns, 'resources': resources}, file, default=str)
+        os.replace(temp_path, self.path)
+
+    def findings(self, row):
+        # The failing check columns of a row, with their values
+        return {column: value for column, value in zip(self.columns, row)
+                if column in self.passing and value != self.passing[column]}
+
+    def finding_changes(self, resource_id, previous_row, row):
+        # Yields a delta row for every finding of a resource that appeared, went away or changed value (e.g. FAIL to UNKNOWN)
+        # A row of None means the resource doesn't exist in that run
+        previous_findings = self.findings(previous_row) if previous_row != None else {}
+        findings = self.findings(row) if row != None else {}
+
+        for column, value in findings.items():
+            if column not in previous_findings:
+                yield ['New', resource_id, column] + row
+            elif api.call_key(previous_findings[column]) != api.call_key(value):
+                yield ['Changed', resource_id, column] + row
+
+        for column in previous_findings:
+            if column not in findings:
+                yield ['Resolved', resource_id, column] + (row if row != None else previous_row)
+
+    def delta_rows(self, complete):
+        # Yields rows describing how this run's findings differ from the previous run's, one row per finding
+        # Findings of resources that are gone are only reported as resolved after a run that listed every resource
+        for resource_id, entry in self.current.items():
+            previous = self.previous.get(resource_id)
+            previous_row = api.decode(previous['row']) if previous != None else None
+            yield from self.finding_changes(resource_id, previous_row, api.decode(entry['row']))
+
+        if not complete:
+            return
+
+        for resource_id, previous in self.previous.items():
+            if resource_id not in self.current:
+                yield from self.finding_changes(resource_id, api.decode(previous['row']), None)
+
+    def write_delta(self, args, name, complete):
+        # Writes the delta report next to the full report, returning how many changes it lists
+        with rw.open_report(args, name, ['Change', 'Resource ID', 'Finding'] + self.columns) as report:
+            report.write_rows(self.delta_rows(complete))
+            return report.rows_written
@@ -0,0 +1,306 @@
+import bisect
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import modules.build_client as bc
+import modules.rate_limiter as rl
+import modules.report_writer as rw
+
+# Upper bounds (in seconds) of the API call latency histogram buckets, matching Prometheus' defaults
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Set by configure() when --metrics is passed; while disabled, stage timing is skipped entirely
+enabled = False
+output_paths = None
+started = time.time()
+
+operations = {}
+operations_lock = threading.Lock()
+stages = {}
+stages_lock = threading.Lock()
+
+# Stage timers open on the current thread, each holding the time spent in the stages nested inside it
+timer_stack = threading.local()
+
+
+class OperationMetrics:
+    # Counters for one API operation of one service
+
+    def __init__(self, service, operation):
+        self.service = service
+        self.operation = operation
+        self.calls = 0
+        self.local_calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency_sum = 0.0
+        self.latency_counts = [0] * (len(latency_buckets) + 1)
+
+    def as_dict(self):
+        return {'service': self.service, 'operation': self.operation, 'calls': self.calls,
+                'local_calls': self.local_calls, 'errors': self.errors, 'retries': self.retries,
+                'throttles': self.throttles, 'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes, 'latency_seconds_sum': round(self.latency_sum, 6),
+                'latency_histogram': dict(zip([str(bound) for bound in latency_buckets] + ['+Inf'],
+                                              self.latency_counts))}
+
+
+def add_metrics_arguments(parser):
+    # Adds the metrics argument shared by every audit script
+    parser.add_argument('--metrics', action='store_true',
+                        help='Record API call counts, latencies, retries, throttles and bytes per operation, plus time spent in each audit stage, and write them to the output directory as JSON and as a Prometheus textfile collector (.prom) file.',
+                        required=False)
+
+
+def configure(args):
+    # Instruments every client created by modules/build_client, if --metrics was passed
+    global enabled, output_paths
+
+    if not args.metrics:
+        return
+
+    # Files are named after the script that was run, so each one keeps its own Prometheus textfile
+    name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'audit'
+    stamp = '-' + rw.run_timestamp if args.timestamp else ''
+    output_paths = (os.path.join(args.output_dir, name + '_metrics' + stamp + '.json'),
+                    os.path.join(args.output_dir, name + '_metrics.prom'))
+    enabled = True
+    bc.register_client_hook(register)
+
+
+def register(client):
+    # Attaches the instrumentation handlers to a client's event system
+    events = client.meta.events
+    events.register_first('before-parameter-build', start_call, unique_id='metrics-start-call')
+    events.register('before-send', count_request, unique_id='metrics-count-request')
+    events.register('response-received', count_response, unique_id='metrics-count-response')
+    events.register('after-call', finish_call, unique_id='metrics-finish-call')
+    events.register('after-call-error', fail_call, unique_id='metrics-fail-call')
+
+
+def get_operation(service, operation):
+    key = (service, operation)
+
+    with operations_lock:
+        if key not in operations:
+            operations[key] = OperationMetrics(service, operation)
+
+        return operations[key]
+
+
+def event_operation(event_name):
+    # Works out the service and operation from an event name such as before-send.s3.GetBucketAcl
+    parts = event_name.split('.')
+
+    return get_operation(parts[1], parts[2])
+
+
+def start_call(context, **kwargs):
+    # Called once per API call, before any cache, replay or HTTP handling, so latency covers the whole call
+    context['audit_call_started'] = time.perf_counter()
+
+
+def count_request(event_name, request, **kwargs):
+    # Called before every HTTP attempt; counts the bytes sent
+    body = request.body
+    if not isinstance(body, (bytes, str)):
+        return
+
+    metrics = event_operation(event_name)
+    with operations_lock:
+        metrics.request_bytes += len(body)
+
+
+def count_response(event_name, response_dict, parsed_response, **kwargs):
+    # Called after every HTTP attempt; counts the bytes received and throttled responses
+    if response_dict == None:
+        return
+
+    body = response_dict.get('body')
+    error_code = (parsed_response or {}).get('Error', {}).get('Code')
+    throttled = error_code in rl.throttle_codes or response_dict.get('status_code') == 429
+    metrics = event_operation(event_name)
+
+    with operations_lock:
+        if isinstance(body, bytes):
+            metrics.response_bytes += len(body)
+        if throttled:
+            metrics.throttles += 1
+
+
+def record_latency(metrics, context):
+    started_at = context.pop('audit_call_started', None)
+    if started_at == None:
+        return
+
+    latency = time.perf_counter() - started_at
+    metrics.latency_sum += latency
+    metrics.latency_counts[bisect.bisect_left(latency_buckets, latency)] += 1
+
+
+def finish_call(event_name, http_response, parsed, context, **kwargs):
+    # Called once per API call with its final response, whether it came from AWS, the cache or a replayed archive
+    metrics = event_operation(event_name)
+
+    with operations_lock:
+        metrics.calls += 1
+        # Responses answered without a network request (cache, replay) have no raw HTTP response behind them
+        if http_response.raw == None:
+            metrics.local_calls += 1
+        if http_response.status_code >= 300:
+            metrics.errors += 1
+        metrics.retries += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        record_latency(metrics, context)
+
+
+def fail_call(event_name, context, **kwargs):
+    # Called when a call fails without any response, e.g. after running out of retries on connection errors
+    metrics = event_operation(event_name)
+
+    with operations_lock:
+        metrics.calls += 1
+        metrics.errors += 1
+        record_latency(metrics, context)
+
+
+@contextlib.contextmanager
+def stage(audit, name):
+    # Times one stage of an audit (discovery, evaluation, report), summed across threads
+    # Time spent in stages nested inside this one is only counted towards the nested stage
+    if not enabled:
+        yield
+        return
+
+    if not hasattr(timer_stack, 'nested'):
+        timer_stack.nested = []
+
+    timer_stack.nested.append(0.0)
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        nested = timer_stack.nested.pop()
+        if timer_stack.nested:
+            timer_stack.nested[-1] += elapsed
+
+        with stages_lock:
+            stages[(audit, name)] = stages.get((audit, name), 0.0) + elapsed - nested
+
+
+def timed(audit, name, iterable):
+    # Wraps a generator so the time spent producing each item counts towards a stage
+    # Audits stream discovery into evaluation into the report, so the stages interleave rather than run one after another
+    if not enabled:
+        return iterable
+
+    return timed_items(audit, name, iter(iterable))
+
+
+def timed_items(audit, name, iterator):
+    while True:
+        with stage(audit, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+        yield item
+
+
+def summary():
+    # Everything recorded during the run, as written to the JSON file
+    with operations_lock:
+        operation_list = [metrics.as_dict() for key, metrics in sorted(operations.items())]
+    with stages_lock:
+        stage_list = [{'audit': audit, 'stage': name, 'seconds': round(seconds, 4)}
+                      for (audit, name), seconds in sorted(stages.items())]
+
+    return {'started': datetime.datetime.fromtimestamp(started, datetime.timezone.utc).isoformat(),
+            'run_seconds': round(time.time() - started, 4), 'operations': operation_list, 'stages': stage_list}
+
+
+def format_labels(labels):
+    # Formats (name, value) pairs as Prometheus labels, e.g. {service="s3",operation="GetBucketAcl"}
+    if not labels:
+        return ''
+
+    return '{' + ','.join(name + '="' + str(value) + '"' for name, value in labels) + '}'
+
+
+def prometheus_text(run_summary):
+    # Formats the summary in the Prometheus text exposition format, for node_exporter's textfile collector
+    lines = []
+
+    def header(name, metric_type, help_text):
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+
+    def sample(name, labels, value):
+        lines.append(name + format_labels(labels) + ' ' + str(value))
+
+    operation_counters = [('calls', 'API calls made, including those answered locally.'),
+                          ('local_calls', 'API calls answered by the response cache or a replayed archive.'),
+                          ('errors', 'API calls that returned an error.'),
+                          ('retries', 'Retried HTTP attempts.'),
+                          ('throttles', 'HTTP attempts throttled by AWS.'),
+                          ('request_bytes', 'Request body bytes sent.'),
+                          ('response_bytes', 'Response body bytes received.')]
+
+    for field, help_text in operation_counters:
+        name = 'aws_audit_api_' + field + '_total'
+        header(name, 'counter', help_text)
+        for entry in run_summary['operations']:
+            sample(name, [('service', entry['service']), ('operation', entry['operation'])], entry[field])
+
+    # Prometheus histogram buckets are cumulative, each counting every call at or below its bound
+    name = 'aws_audit_api_call_duration_seconds'
+    header(name, 'histogram', 'API call latency, including retries and rate limiting.')
+    for entry in run_summary['operations']:
+        labels = [('service', entry['service']), ('operation', entry['operation'])]
+        cumulative = 0
+        for bound, count in entry['latency_histogram'].items():
+            cumulative += count
+            sample(name + '_bucket', labels + [('le', bound)], cumulative)
+        sample(name + '_sum', labels, entry['latency_seconds_sum'])
+        sample(name + '_count', labels, entry['calls'])
+
+    header('aws_audit_stage_seconds', 'gauge', 'Time spent in each audit stage, summed across threads.')
+    for entry in run_summary['stages']:
+        sample('aws_audit_stage_seconds', [('audit', entry['audit']), ('stage', entry['stage'])], entry['seconds'])
+
+    header('aws_audit_run_seconds', 'gauge', 'Wall-clock duration of the run.')
+    sample('aws_audit_run_seconds', [], run_summary['run_seconds'])
+    header('aws_audit_last_run_timestamp_seconds', 'gauge', 'When the run started.')
+    sample('aws_audit_last_run_timestamp_seconds', [], round(started, 3))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, text):
+    # Written to a temporary file first, so the textfile collector never reads a half written file
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(text)
+    os.replace(temp_path, path)
+
+
+def print_summary():
+    # Writes the JSON and Prometheus files, when --metrics is enabled
+    if not enabled:
+        return
+
+    run_summary = summary()
+    json_path, prometheus_path = output_paths
+    write_file(json_path, json.dumps(run_summary, indent=2))
+    write_file(prometheus_path, prometheus_text(run_summary))
+    print('Metrics: ' + str(sum(entry['calls'] for entry in run_summary['operations'])) +
+          ' API calls recorded. Written to ' + json_path + ' and ' + prometheus_path + '.')
@@ -0,0 +1,138 @@
+import re
+import threading
+import boto3
+import botocore.session
+from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+import modules.build_client as bc
+import modules.discovery as dsc
+
+# Session name recorded in CloudTrail for every role assumed by an organization run
+role_session_name = 'aws-audit-scripts'
+
+# The account and partition the profile's own credentials belong to, looked up once per run
+caller = {}
+caller_lock = threading.Lock()
+
+# botocore components that only depend on the installed service models, shared by every assumed role session rather
+# than loaded again for each account
+shared_components = ('data_loader', 'endpoint_resolver', 'exceptions_factory', 'response_parser_factory')
+
+
+def add_organization_arguments(parser):
+    # Adds the organization mode arguments used by audit.py
+    parser.add_argument('--org', action='store_true',
+                        help='Audit every active account in the AWS Organization, listed with the profile\'s credentials (management or delegated administrator account). Reports from every account are merged, with an Account ID column.',
+                        required=False)
+    parser.add_argument('--accounts-file', action='store', type=str, default=None,
+                        help='Audit the accounts listed in this file instead, one account ID per line. Blank lines, # comments and anything after the ID (e.g. a name column) are ignored.',
+                        required=False)
+    parser.add_argument('--role-name', action='store', type=str, default='OrganizationAccountAccessRole',
+                        help='The role assumed in each account. Defaults to OrganizationAccountAccessRole.',
+                        required=False)
+    parser.add_argument('--external-id', action='store', type=str, default=None,
+                        help='External ID passed when assuming the role, if its trust policy requires one.',
+                        required=False)
+    parser.add_argument('--org-concurrency', action='store', type=int, default=8,
+                        help='The most account audits run at the same time across the whole organization. Defaults to 8.',
+                        required=False)
+
+
+def is_organization_run(args):
+    # Whether audit.py was asked to audit several accounts rather than the profile's own
+    return args.org == True or args.accounts_file != None
+
+
+def read_accounts_file(path):
+    # Reads account IDs from a file, one per line; the first field of each line is the ID
+    accounts = []
+
+    with open(path) as file:
+        for line in file:
+            fields = re.split('[\\s,]+', line.split('#')[0].strip())
+            if fields[0] == '':
+                continue
+            if not re.fullmatch('[0-9]{12}', fields[0]):
+                print('ERROR: "' + fields[0] + '" in ' + path + ' is not a 12 digit account ID.')
+                exit(4)
+            accounts.append(fields[0])
+
+    return accounts
+
+
+def get_accounts(args):
+    # Determines which accounts to audit, in the order given (from the file) or listed (from Organizations)
+    if args.accounts_file != None:
+        accounts = read_accounts_file(args.accounts_file)
+    else:
+        # Suspended accounts can't be accessed, so only active ones are audited
+        organizations = bc.build_client(args.profile, 'organizations', args.region)
+        accounts = [account['Id'] for account in dsc.paginate(organizations, 'list_accounts', 'Accounts')
+                    if account.get('Status') == 'ACTIVE']
+
+    # An account listed twice would otherwise be audited (and reported) twice
+    return list(dict.fromkeys(accounts))
+
+
+def get_caller(args):
+    # The account and partition (aws, aws-cn, aws-us-gov) of the profile's credentials
+    with caller_lock:
+        if not caller:
+            sts = bc.build_client(args.profile, 'sts', args.region)
+            identity = sts.get_caller_identity()
+            caller['Account'] = identity['Account']
+            caller['Partition'] = identity['Arn'].split(':')[1]
+
+        return caller
+
+
+def locked_client_creator(source):
+    # AssumeRoleCredentialFetcher creates its STS client when credentials are first fetched or refreshed, which happens on
+    # whichever worker thread uses them; sessions aren't thread safe, so the client is created under build_client's lock
+    def client_creator(*client_args, **client_kwargs):
+        with bc.cache_lock:
+            return source.client(*client_args, **client_kwargs)
+
+    return client_creator
+
+
+def assume_role_session(args, role_arn):
+    # Builds a session whose credentials come from assuming role_arn with the profile's credentials
+    # The role is only assumed when the session is first used, and the credentials are cached in memory and refreshed
+    # shortly before they expire, so audits running longer than the role's session duration carry on without errors
+    source = bc.get_session(args.profile)
+    extra_args = {'RoleSessionName': role_session_name}
+    if args.external_id != None:
+        extra_args['ExternalId'] = args.external_id
+
+    fetcher = AssumeRoleCredentialFetcher(client_creator=locked_client_creator(source), source_credentials=source.get_credentials(),
+                                          role_arn=role_arn, extra_args=extra_args)
+    credentials = DeferredRefreshableCredentials(refresh_using=fetcher.fetch_credentials, method='assume-role')
+
+    botocore_session = botocore.session.Session()
+    botocore_session._credentials = credentials
+    for name in shared_components:
+        botocore_session.register_component(name, source._session.get_component(name))
+
+    with bc.cache_lock:
+        session = boto3.session.Session(botocore_session=botocore_session, region_name=source.region_name)
+
+        # Boto3 adds its own data directory to the (now shared) loader for every session, so the repeats are dropped
+        loader = botocore_session.get_component('data_loader')
+        loader.search_paths[:] = list(dict.fromkeys(loader.search_paths))
+
+    return session
+
+
+def get_account_profile(args, account_id):
+    # Returns the name modules/build_client knows an account's session by, for use in place of a profile name
+    # The account the profile itself belongs to (usually the management account) is audited with the profile's own credentials
+    current = get_caller(args)
+    if account_id == current['Account']:
+        return args.profile
+
+    name = str(args.profile) + '/' + account_id
+    if name not in bc.sessions:
+        role_arn = 'arn:' + current['Partition'] + ':iam::' + account_id + ':role/' + args.role_name
+        bc.add_session(name, assume_role_session(args, role_arn))
+
+    return name
@@ -0,0 +1,148 @@
+import threading
+import time
+import modules.build_client as bc
+
+# Error codes AWS services use to signal that a caller is sending requests too quickly
+throttle_codes = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'BandwidthLimitExceeded',
+                  'ProvisionedThroughputExceededException', 'PriorRequestNotComplete', 'EC2ThrottledException'}
+
+# Starting point and bounds for every operation's limits; they adapt from here as calls succeed or are throttled
+initial_rate = 50.0
+min_rate = 1.0
+max_rate = 1000.0
+initial_concurrency = 50
+max_concurrency = 200
+
+# A burst of throttles from calls that were already in flight only counts as a single slow down within this window
+throttle_cooldown = 1.0
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+class OperationLimiter:
+    # Token bucket plus in-flight limit for a single service/operation pair in one account and region
+    # Both back off multiplicatively when throttled and recover additively as calls succeed (AIMD)
+
+    def __init__(self, name):
+        self.name = name
+        self.rate = initial_rate
+        self.tokens = initial_rate
+        self.concurrency = initial_concurrency
+        self.in_flight = 0
+        self.last_refill = time.monotonic()
+        self.last_throttle = 0.0
+        self.successes = 0
+        self.calls = 0
+        self.throttles = 0
+        self.wait_time = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        # Blocks until a token and an in-flight slot are available, recording how long the caller was held back
+        started = time.monotonic()
+
+        with self.condition:
+            while True:
+                self.refill()
+                if self.tokens >= 1 and self.in_flight < self.concurrency:
+                    break
+
+                # Sleep until the next token is due, or until a slot is released
+                if self.tokens >= 1:
+                    self.condition.wait()
+                else:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+
+            self.tokens -= 1
+            self.in_flight += 1
+            self.calls += 1
+            self.wait_time += time.monotonic() - started
+
+    def release(self, throttled):
+        # Frees an in-flight slot and adapts the limits based on whether the call was throttled
+        with self.condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            now = time.monotonic()
+
+            if throttled:
+                self.throttles += 1
+                if now - self.last_throttle > throttle_cooldown:
+                    self.rate = max(min_rate, self.rate / 2)
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self.tokens = min(self.tokens, 1)
+                    self.last_throttle = now
+                    self.successes = 0
+
+            else:
+                self.successes += 1
+                self.rate = min(max_rate, self.rate + 0.5)
+                if self.successes >= self.concurrency:
+                    self.concurrency = min(max_concurrency, self.concurrency + 1)
+                    self.successes = 0
+
+            self.condition.notify_all()
+
+    def refill(self):
+        # Adds the tokens earned since the last refill, capped at one second's worth of burst
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+
+def get_limiter(scope, event_name):
+    # Returns the limiter for a (profile, region) scope and the service/operation in a botocore event name, e.g. before-send.s3.GetBucketAcl
+    # AWS applies its limits per account and region, so throttling in one never slows calls to another
+    parts = event_name.split('.')
+    key = scope + (parts[1], parts[2])
+
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = OperationLimiter(parts[1] + ':' + parts[2] + ' in ' + str(scope[1]) + ' (' + scope[0] + ')')
+
+        return limiters[key]
+
+
+def is_throttled(response):
+    # Checks an attempt's response for throttling error codes or HTTP statuses
+    if response == None:
+        return False
+
+    http_response, parsed = response
+    if parsed.get('Error', {}).get('Code') in throttle_codes:
+        return True
+
+    return http_response.status_code == 429
+
+
+def register(client):
+    # Attaches the limiter to a client's event system, bound to the account (profile) and region the client calls
+    scope = (bc.client_profiles.get(client, 'default'), client.meta.region_name)
+
+    def before_send(event_name, **kwargs):
+        # Called by botocore before every HTTP attempt, including retries
+        get_limiter(scope, event_name).acquire()
+
+    def needs_retry(event_name, response=None, caught_exception=None, **kwargs):
+        # Called by botocore after every HTTP attempt; returns None so botocore's own retry logic still decides on retries
+        get_limiter(scope, event_name).release(is_throttled(response))
+
+    client.meta.events.register('before-send', before_send, unique_id='rate-limiter-before-send')
+    client.meta.events.register('needs-retry', needs_retry, unique_id='rate-limiter-needs-retry')
+
+
+def enable():
+    # Rate limits every client created by modules/build_client from now on
+    bc.register_client_hook(register)
+
+
+def print_summary():
+    # Reports how many calls each operation made, how often it was throttled and how long calls waited for capacity
+    with limiters_lock:
+        throttled = [limiter for limiter in limiters.values() if limiter.throttles or limiter.wait_time >= 1]
+
+    for limiter in sorted(throttled, key=lambda limiter: limiter.name):
+        print('Rate limiting: ' + limiter.name + ' made ' + str(limiter.calls) + ' calls, was throttled ' +
+              str(limiter.throttles) + ' times and spent ' + format(limiter.wait_time, '.1f') +
+              's waiting for capacity across all threads (settled at ' + format(limiter.rate, '.1f') + ' calls/s).')
@@ -0,0 +1,116 @@
+import atexit
+import collections
+import gzip
+import json
+import os
+import threading
+import boto3
+from botocore.awsrequest import AWSResponse
+import modules.api_calls as api
+import modules.build_client as bc
+
+# Archive being written to (record mode), or the recorded responses waiting to be replayed (replay mode)
+archive = None
+archive_lock = threading.Lock()
+responses = {}
+replayed = 0
+
+
+class ReplayMissError(Exception):
+    # Raised when a replayed run makes a call that was never recorded
+    pass
+
+
+def add_recording_arguments(parser):
+    # Adds the record/replay arguments shared by every audit script
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', action='store', type=str, default=None, metavar='ARCHIVE',
+                       help='Record every API request and response of this run into a gzip compressed archive (e.g. ./output/run.jsonl.gz).')
+    group.add_argument('--replay', action='store', type=str, default=None, metavar='ARCHIVE',
+                       help='Run the audit against a recorded archive instead of AWS. No credentials or network access are needed.')
+
+
+def configure(args):
+    # Turns on record or replay mode for every client created by modules/build_client
+    global archive
+
+    if args.record != None:
+        # The archive often goes next to the reports (e.g. output/run.json.gz), which may not exist yet on a first run
+        os.makedirs(os.path.dirname(args.record) or '.', exist_ok=True)
+        archive = gzip.open(args.record, 'wt')
+        # The profile's region is kept so replayed runs resolve the same default region without the profile
+        write_line({'default_region': bc.get_session(args.profile).region_name})
+        atexit.register(archive.close)
+        bc.register_client_hook(register_recorder)
+
+    elif args.replay != None:
+        default_region = load_archive(args.replay)
+        # Replayed calls never reach AWS, so the session only needs placeholder credentials and the recorded region
+        bc.offline_session = boto3.session.Session(aws_access_key_id='replay', aws_secret_access_key='replay',
+                                                   region_name=default_region)
+        bc.register_client_hook(register_replayer)
+
+
+def write_line(entry):
+    with archive_lock:
+        archive.write(json.dumps(entry, separators=(',', ':'), default=str) + '\n')
+
+
+def register_recorder(client):
+    api.register(client)
+    client.meta.events.register('after-call', record_call, unique_id='recorder-record')
+
+
+def record_call(http_response, parsed, model, context, **kwargs):
+    # Appends one call and its response to the archive
+    service, region, operation, params = api.call_details(model, context)
+    write_line({'service': service, 'region': region, 'operation': operation, 'params': api.encode(params),
+                'status': http_response.status_code, 'parsed': api.encode(parsed)})
+
+
+def load_archive(path):
+    # Indexes the recorded responses by call, keeping repeated calls in the order they were made
+    default_region = None
+
+    with gzip.open(path, 'rt') as file:
+        for line in file:
+            entry = json.loads(line)
+
+            if 'default_region' in entry:
+                default_region = entry['default_region']
+                continue
+
+            key = api.call_key(entry['service'], entry['region'], entry['operation'], entry['params'])
+            responses.setdefault(key, collections.deque()).append((entry['status'], entry['parsed']))
+
+    return default_region
+
+
+def register_replayer(client):
+    api.register(client)
+    client.meta.events.register_first('before-call', replay_call, unique_id='recorder-replay')
+
+
+def replay_call(model, context, **kwargs):
+    # Answers a call from the archive; the last recording of a call is reused if it is made more often than it was recorded
+    global replayed
+
+    service, region, operation, params = api.call_details(model, context)
+    key = api.call_key(service, region, operation, api.encode(params))
+
+    with archive_lock:
+        recorded = responses.get(key)
+        if not recorded:
+            raise ReplayMissError('No recorded response for ' + service + ' ' + operation + ' in ' + str(region) +
+                                  ' with parameters ' + json.dumps(api.encode(params), default=str))
+
+        status, parsed = recorded[0] if len(recorded) == 1 else recorded.popleft()
+        replayed += 1
+
+    return AWSResponse(operation, status, {}, None), api.decode(parsed)
+
+
+def print_summary():
+    # Reports how many calls were served from the archive when replaying
+    if replayed:
+        print('Replay: ' + str(replayed) + ' calls answered from the recorded archive.')
@@ -0,0 +1,58 @@
+import modules.build_client as bc
+import modules.worker_pool as wp
+
+
+def add_region_arguments(parser):
+    # Adds the multi-region arguments shared by the regional audit scripts
+    parser.add_argument('--regions', action='store', type=str,
+                        help='Comma separated list of regions to audit in parallel, e.g. us-east-1,eu-west-1. Adds a Region column to the report.',
+                        required=False, default=None)
+    parser.add_argument('--all-regions', action='store_true',
+                        help='Audit every region enabled for the account in parallel. Adds a Region column to the report.',
+                        required=False)
+
+
+def is_multi_region(args):
+    # Whether the script was asked to audit more than the single -r/profile region
+    return args.regions != None or args.all_regions == True
+
+
+def get_regions(args):
+    # Determines which regions to audit from the cmd line arguments
+    if args.regions != None:
+        return [region.strip() for region in args.regions.split(',') if region.strip()]
+
+    if args.all_regions == True:
+        # describe_regions only returns the regions that are enabled (or opted in) for the account
+        ec2 = bc.build_client(args.profile, 'ec2', args.region)
+        regions = ec2.describe_regions()['Regions']
+        return sorted(region['RegionName'] for region in regions)
+
+    return [args.region]
+
+
+def audit_regions(audit_region, regions):
+    # Runs audit_region for every region at the same time in this process, yielding (region, result) pairs
+    # Regions are returned in the order given, and a region that fails is reported without losing the others
+    for region, result, error in wp.run_concurrently(lambda region: audit_one_region(audit_region, region), regions, len(regions)):
+        if error != None:
+            print('WARNING: Could not audit region ' + str(region) + ' (' + type(error).__name__ + ': ' + str(error) + ').')
+            continue
+
+        yield region, result
+
+
+def audit_one_region(audit_region, region):
+    # Discovery exits on credential and permission errors (see modules/discovery), e.g. when an SCP denies a region;
+    # in a region worker that would end every region's audit, so it only fails this region instead
+    try:
+        return audit_region(region)
+    except SystemExit as error:
+        raise RuntimeError('exited with status ' + str(error.code)) from None
+
+
+def prefix_region(region_results):
+    # Flattens the per-region report rows from audit_regions into single rows with the region as the first column
+    for region, rows in region_results:
+        for row in rows:
+            yield [region] + list(row)
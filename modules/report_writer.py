@@ -0,0 +1,242 @@
+import csv
+import datetime
+import gzip
+import importlib
+import json
+import os
+import threading
+
+# File extension written for each --format choice
+extensions = {'csv': '.csv', 'csv.gz': '.csv.gz', 'csv.zst': '.csv.zst', 'jsonl': '.jsonl', 'jsonl.gz': '.jsonl.gz',
+              'parquet': '.parquet'}
+
+# Formats that need a package which isn't in requirements.txt
+optional_packages = {'csv.zst': 'zstandard', 'parquet': 'pyarrow'}
+
+# Every report of a run is stamped with the time the run started, so reports written together share one timestamp
+run_timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+# Reports shared by every account of an organization run (see audit.py), by path
+merged_reports = {}
+merged_reports_lock = threading.Lock()
+
+
+def add_output_arguments(parser):
+    # Adds the report format and location arguments shared by every audit script
+    parser.add_argument('--format', action='store', type=str, choices=list(extensions), default='csv',
+                        help='Format of the report(s). jsonl and parquet keep nested values (e.g. security groups) as lists and objects rather than text; csv.zst needs the zstandard package and parquet needs pyarrow. Defaults to csv.',
+                        required=False)
+    parser.add_argument('--output-dir', action='store', type=str, default='./output',
+                        help='Directory the report(s) are written to. Defaults to ./output.',
+                        required=False)
+    parser.add_argument('--timestamp', action='store_true',
+                        help='Add the UTC time the run started to report file names (e.g. s3_public_data-20240101T120000Z.csv), so earlier reports are kept.',
+                        required=False)
+
+
+def check_format(format):
+    # Exits before any API calls are made if the chosen format needs an optional package that isn't installed
+    package = optional_packages.get(format)
+    if package == None:
+        return
+
+    try:
+        importlib.import_module(package)
+    except ImportError:
+        print('Error: The ' + format + ' format needs the ' + package + ' package. Install it with `pip install ' + package + '`.')
+        exit(4)
+
+
+def report_path(args, name):
+    # Works out where a report is written from the cmd line arguments, e.g. ./output/s3_public_data.csv
+    stamp = '-' + run_timestamp if args.timestamp else ''
+
+    return os.path.join(args.output_dir, name + stamp + extensions[args.format])
+
+
+def account_name(args, name):
+    # Names the files kept between runs (progress journals, incremental state) after the account in an organization run,
+    # so accounts audited at the same time don't share them
+    account_id = getattr(args, 'account_id', None)
+    if account_id == None:
+        return name
+
+    return name + '_' + account_id
+
+
+def open_report(args, name, columns):
+    # Opens the named report for writing, e.g. open_report(args, 's3_public_data', columns)
+    # In an organization run, audit.py sets args.account_id, and the rows go to one report shared by every account instead
+    account_id = getattr(args, 'account_id', None)
+    if account_id == None:
+        return ReportWriter(report_path(args, name), columns)
+
+    path = report_path(args, name)
+    with merged_reports_lock:
+        if path not in merged_reports:
+            merged_reports[path] = ReportWriter(path, ['Account ID'] + list(columns))
+
+        return AccountReport(merged_reports[path], account_id, columns)
+
+
+def close_merged_reports():
+    # Finishes every report written during an organization run, returning their paths
+    with merged_reports_lock:
+        paths = list(merged_reports)
+        for report in merged_reports.values():
+            report.close()
+        merged_reports.clear()
+
+    return paths
+
+
+def format_of(path):
+    # The format a report is written in is taken from its file extension; the longest match wins (.csv.gz before .csv)
+    for format, extension in sorted(extensions.items(), key=lambda item: -len(item[1])):
+        if path.endswith(extension):
+            return format
+
+    return 'csv'
+
+
+def native_value(value):
+    # Cells left empty in CSV reports (and pandas' NaN) are written as nulls, so each column keeps a single type
+    if value == '' or (isinstance(value, float) and value != value):
+        return None
+
+    return value
+
+
+def json_default(value):
+    # Timestamps are written as ISO 8601 strings; anything else JSON can't represent is written as text
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    return str(value)
+
+
+def column_array(values):
+    # Converts one column to Arrow, keeping its native type (booleans, numbers, timestamps, lists of structs)
+    # A column that mixes types, such as a check recording an error for one resource, is stored as text instead
+    import pyarrow
+
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return pyarrow.array([None if value == None else
+                              json.dumps(value, default=json_default) if isinstance(value, (list, dict)) else str(value)
+                              for value in values], type=pyarrow.string())
+
+
+def open_text(path, format):
+    # Opens a text file for writing, compressed to match the format
+    if format.endswith('.gz'):
+        return gzip.open(path, 'wt', newline='')
+
+    if format.endswith('.zst'):
+        import zstandard
+        return zstandard.open(path, 'wt', newline='')
+
+    return open(path, 'w', newline='')
+
+
+class ReportWriter:
+    # Streams report rows to a file as soon as they are produced, so memory use stays flat however large the report gets
+    # Rows can be passed in as lists (in column order) or as dicts keyed by column name
+    # The format comes from the path's extension: CSV and JSON lines are streamed (optionally compressed), while Parquet
+    # collects the report column by column and writes it when the writer is closed
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.format = format_of(path)
+        self.rows_written = 0
+        self.file = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        if self.format == 'parquet':
+            self.values = {column: [] for column in self.columns}
+            return
+
+        self.file = open_text(path, self.format)
+        if self.format.startswith('csv'):
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.columns)
+
+    def write_row(self, row):
+        # Writes a single finding row straight through to the output file
+        if isinstance(row, dict):
+            row = [row.get(column, '') for column in self.columns]
+
+        if self.format.startswith('csv'):
+            # pandas' NaN (a missing value) is written as an empty cell, as DataFrame.to_csv does
+            self.writer.writerow(['' if isinstance(value, float) and value != value else value for value in row])
+        elif self.format == 'parquet':
+            for column, value in zip(self.columns, row):
+                self.values[column].append(native_value(value))
+        else:
+            record = {column: native_value(value) for column, value in zip(self.columns, row)}
+            self.file.write(json.dumps(record, default=json_default) + '\n')
+
+        self.rows_written += 1
+
+    def write_rows(self, rows):
+        # Writes every row from an iterable (usually a generator) without collecting them first
+        for row in rows:
+            self.write_row(row)
+
+    def write_parquet(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        arrays = [column_array(self.values[column]) for column in self.columns]
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, names=self.columns), self.path)
+
+    def close(self):
+        if self.format == 'parquet':
+            self.write_parquet()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AccountReport:
+    # One account's part of a report shared by every account of an organization run, with the account ID as the first column
+    # Rows are held until the account's report is complete and then written together, so each account's rows stay in one block
+    # and accounts audited at the same time never wait on each other while they are still evaluating
+
+    def __init__(self, report, account_id, columns):
+        self.report = report
+        self.path = report.path
+        self.account_id = account_id
+        self.columns = list(columns)
+        self.rows = []
+        self.rows_written = 0
+
+    def write_row(self, row):
+        if isinstance(row, dict):
+            row = [row.get(column, '') for column in self.columns]
+
+        self.rows.append([self.account_id] + list(row))
+        self.rows_written += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        with merged_reports_lock:
+            self.report.write_rows(self.rows)
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
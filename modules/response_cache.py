@@ -0,0 +1,225 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from botocore.awsrequest import AWSResponse
+import modules.api_calls as api
+import modules.build_client as bc
+
+# Cache settings; overwritten from the cmd line arguments by configure()
+cache_dir = './output/.cache'
+ttl = 3600
+max_size = 256 * 1024 * 1024
+profile = None
+
+# Error responses that are real answers about a resource rather than a failed call, so they are cached like a 2xx
+cached_errors = {
+    'NoSuchBucket',
+    'NoSuchBucketPolicy',
+    'NoSuchPublicAccessBlockConfiguration',
+    'ServerSideEncryptionConfigurationNotFoundError',
+    'NoSuchTagSet',
+    'NoSuchLifecycleConfiguration',
+    'NoSuchCORSConfiguration',
+    'NoSuchWebsiteConfiguration',
+    'ReplicationConfigurationNotFoundError',
+    'ObjectLockConfigurationNotFoundError',
+    'OwnershipControlsNotFoundError',
+}
+
+# Account IDs already resolved for each set of credentials during this run
+accounts = {}
+accounts_lock = threading.Lock()
+size_lock = threading.Lock()
+stats_lock = threading.Lock()
+cache_size = None
+hits = 0
+misses = 0
+
+
+def add_cache_arguments(parser):
+    # Adds the response cache arguments shared by every audit script
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=False,
+                        help='Reuse describe/list/get API responses stored by earlier runs, and store new ones. Disabled by default.')
+    parser.add_argument('--cache-ttl', action='store', type=int, default=3600,
+                        help='How many seconds cached API responses stay valid. Defaults to 3600.')
+    parser.add_argument('--cache-dir', action='store', type=str, default='./output/.cache',
+                        help='Where cached API responses are stored. Defaults to ./output/.cache.')
+    parser.add_argument('--cache-max-size', action='store', type=int, default=256,
+                        help='Maximum size of the cache in MB; the least recently used responses are evicted first. Defaults to 256.')
+
+
+def configure(args):
+    # Turns the cache on for every client created by modules/build_client, if --cache was passed
+    global cache_dir, ttl, max_size, profile
+
+    # A replayed run never reaches AWS, so there is nothing to cache
+    if not args.cache or getattr(args, 'replay', None) != None:
+        return
+
+    cache_dir = args.cache_dir
+    ttl = args.cache_ttl
+    max_size = args.cache_max_size * 1024 * 1024
+    profile = args.profile
+    os.makedirs(cache_dir, exist_ok=True)
+    bc.register_client_hook(register)
+
+
+def register(client):
+    # Attaches the cache lookup and store handlers to a client
+    api.register(client)
+    client.meta.events.register_first('before-call', lookup, unique_id='response-cache-lookup')
+    client.meta.events.register('after-call', store, unique_id='response-cache-store')
+
+
+def get_account(context):
+    # Identifies the account a call is made against, so responses from different accounts never mix
+    # Resolved once per set of credentials and kept on disk, meaning repeat runs don't need an STS call
+    credentials = context['audit_credentials']
+    fingerprint = hashlib.sha256(credentials.access_key.encode()).hexdigest()
+
+    with accounts_lock:
+        if fingerprint in accounts:
+            return accounts[fingerprint]
+
+        path = os.path.join(cache_dir, 'account-' + fingerprint + '.json.gz')
+        entry = read_entry(path)
+        if entry != None:
+            accounts[fingerprint] = entry['Account']
+        else:
+            sts = bc.build_client(session_name(credentials), 'sts', context.get('client_region'))
+            accounts[fingerprint] = sts.get_caller_identity()['Account']
+            write_entry(path, {'Account': accounts[fingerprint]})
+
+        return accounts[fingerprint]
+
+
+def session_name(credentials):
+    # The name modules/build_client knows the session holding these credentials by (an org member account's assumed
+    # role session, say), falling back to the profile; the STS client then gets the same settings as every other client
+    with bc.cache_lock:
+        for name, session in bc.sessions.items():
+            session_credentials = session.get_credentials()
+            if session_credentials != None and session_credentials.access_key == credentials.access_key:
+                return name
+
+    return profile
+
+
+def entry_path(model, context, request_signer):
+    # Works out where the response for this call is stored: one file per account, region, operation and parameters
+    context['audit_credentials'] = request_signer._credentials.get_frozen_credentials()
+    key = api.call_key(get_account(context), *api.call_details(model, context))
+
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json.gz')
+
+
+def lookup(model, context, request_signer, **kwargs):
+    # Answers a read-only call from the cache when a fresh response is stored; returning None sends the call to AWS
+    global hits, misses
+
+    # GetCallerIdentity is how get_account() works out which account a call belongs to, so it is never cached itself
+    if not api.is_read_only(model.name) or model.name == 'GetCallerIdentity':
+        return None
+
+    path = entry_path(model, context, request_signer)
+    entry = read_entry(path)
+
+    with stats_lock:
+        if entry != None:
+            hits += 1
+            return AWSResponse(model.name, entry['status'], {}, None), api.decode(entry['parsed'])
+
+        misses += 1
+
+    # Tells store() where to save the response once AWS has answered
+    context['audit_cache_path'] = path
+    return None
+
+
+def store(http_response, parsed, context, **kwargs):
+    # Saves a successful response fetched from AWS; errors are only kept when they answer the question (see cached_errors),
+    # so throttles, 5xx and permission errors such as AccessDenied are always asked again
+    path = context.pop('audit_cache_path', None)
+
+    if path == None:
+        return
+    if not 200 <= http_response.status_code < 300 and parsed.get('Error', {}).get('Code') not in cached_errors:
+        return
+
+    write_entry(path, {'status': http_response.status_code, 'parsed': api.encode(parsed)})
+
+
+def read_entry(path):
+    # Returns a stored entry if it exists and was written within the TTL; expired entries are removed
+    try:
+        with gzip.open(path, 'rt') as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - entry.get('stored_at', 0) >= ttl:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    # Touching the file marks it as recently used, so eviction removes the oldest unused responses first
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return entry
+
+
+def write_entry(path, entry):
+    # Writes to a temporary file first so other threads never read a half written entry
+    global cache_size
+
+    entry['stored_at'] = time.time()
+    data = gzip.compress(json.dumps(entry).encode())
+    temp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+    with size_lock:
+        if cache_size == None:
+            cache_size = directory_size()
+        cache_size += len(data)
+
+        if cache_size > max_size:
+            evict()
+
+
+def directory_size():
+    return sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+
+def evict():
+    # Removes the least recently used entries until the cache is back under three quarters of its limit
+    global cache_size
+
+    entries = sorted((entry for entry in os.scandir(cache_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+    cache_size = sum(entry.stat().st_size for entry in entries)
+
+    for entry in entries:
+        if cache_size <= max_size * 0.75:
+            break
+        try:
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            cache_size -= size
+        except OSError:
+            pass
+
+
+def print_summary():
+    # Reports how many calls were answered from the cache, when it is enabled
+    if hits or misses:
+        print('Response cache: ' + str(hits) + ' calls answered from the cache, ' + str(misses) + ' sent to AWS.')
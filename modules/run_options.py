@@ -0,0 +1,28 @@
+import modules.metrics as mt
+import modules.rate_limiter as rl
+import modules.recorder as rec
+import modules.response_cache as rc
+
+
+def configure(args):
+    # Applies the options shared by every audit to all clients created by modules/build_client
+    # Called once per process, before any audit runs, whether it is started on its own or through audit.py
+    # Every client is rate limited per API operation, backing off when AWS throttles calls
+    rl.enable()
+
+    # Optionally record every API call of this run, or replay a recorded run without touching AWS
+    rec.configure(args)
+
+    # Optionally answer describe/list/get calls from responses stored by earlier runs
+    rc.configure(args)
+
+    # Optionally record call counts, latencies, retries and throttles per operation
+    mt.configure(args)
+
+
+def print_summaries():
+    # Reports what the rate limiter, response cache and recorder did during the run, and writes the metrics files
+    rl.print_summary()
+    rc.print_summary()
+    rec.print_summary()
+    mt.print_summary()
@@ -0,0 +1,71 @@
+import re
+import modules.build_client as bc
+import modules.discovery as dsc
+
+
+def add_tag_arguments(parser):
+    # Adds the tag selection argument shared by every audit script
+    parser.add_argument('--tag', action='append', metavar='KEY=VALUE',
+                        help='Only audit resources carrying this tag, e.g. --tag env=prod; can be used more than once. A resource must match every tag key given, and repeating a key matches any of its values. Pass KEY on its own to match any value.',
+                        required=False)
+
+
+def get_tag_filters(tags):
+    # Converts --tag arguments into GetResources tag filters, grouping repeated keys so any of their values match
+    filters = {}
+
+    for tag in tags:
+        key, separator, value = tag.partition('=')
+        if not key.strip():
+            print('ERROR: Invalid tag "' + tag + '". Use KEY=VALUE, or KEY to match any value.')
+            exit(4)
+
+        values = filters.setdefault(key.strip(), [])
+        if separator:
+            values.append(value)
+
+    return [{'Key': key, 'Values': values} if values else {'Key': key} for key, values in filters.items()]
+
+
+def parse_arn(arn):
+    # Splits an ARN into the tagging API's resource type and the resource's ID,
+    # e.g. arn:aws:rds:us-east-1:123456789012:db:my-db -> ('rds:db', 'my-db') and arn:aws:s3:::my-bucket -> ('s3', 'my-bucket')
+    parts = arn.split(':', 5)
+    service, resource = parts[2], parts[5]
+
+    # Bucket ARNs have neither a region nor an account, and are nothing but the bucket name
+    if service == 's3' and parts[3] == '' and parts[4] == '':
+        return 's3', resource
+
+    resource_type, resource_id = re.split('[:/]', resource, maxsplit=1)
+
+    return service + ':' + resource_type, resource_id
+
+
+def get_tagged_ids(profile, region, tags, resource_types):
+    # Looks up every resource of the given types (e.g. rds:db) carrying the --tag tags, returning a set of IDs per type
+    # GetResources returns up to 100 matches per call, so a scoped audit never has to describe the resources around them
+    # The tagging API is regional; S3 buckets are returned by the region they are located in
+    client = bc.build_client(profile, 'resourcegroupstaggingapi', region)
+    resources = dsc.paginate(client, 'get_resources', 'ResourceTagMappingList', TagFilters=get_tag_filters(tags),
+                             ResourceTypeFilters=list(resource_types), ResourcesPerPage=100)
+
+    tagged_ids = {resource_type: set() for resource_type in resource_types}
+    for resource in resources:
+        resource_type, resource_id = parse_arn(resource['ResourceARN'])
+        if resource_type in tagged_ids:
+            tagged_ids[resource_type].add(resource_id)
+
+    return tagged_ids
+
+
+def select(explicit_ids, tagged_ids):
+    # Combines the IDs passed on the cmd line (e.g. -b) with those matched by --tag; a resource has to be in both when both are used
+    # Returns None when neither narrows the audit, meaning every resource is checked
+    if explicit_ids == None:
+        return tagged_ids
+
+    if tagged_ids == None:
+        return set(explicit_ids)
+
+    return set(explicit_ids) & tagged_ids
@@ -0,0 +1,88 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_concurrently(function, items, max_workers):
+    # Runs function against every item on a bounded pool of worker threads
+    # Yields (item, result, error) tuples in the same order the items were passed in, so reports stay deterministic
+    # Only a limited window of items is in flight at once, meaning results can be consumed as they finish without
+    # every pending result being held in memory
+    max_workers = max(1, int(max_workers))
+    window = deque()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            window.append((item, executor.submit(function, item)))
+
+            # Wait on the oldest item once the window is full, so the pool never races too far ahead of the consumer
+            if len(window) >= max_workers * 2:
+                yield collect_result(window.popleft())
+
+        while window:
+            yield collect_result(window.popleft())
+
+
+def collect_result(entry):
+    # Waits for a submitted item to finish and returns its result, or the error it raised, instead of aborting the run
+    item, future = entry
+
+    try:
+        return item, future.result(), None
+    except Exception as error:
+        return item, None, error
+
+
+def interleave(iterables, max_workers, buffer_size=1000):
+    # Drains several iterables at the same time on a pool of threads, yielding their items as soon as they arrive
+    # The buffer between the threads and the consumer is bounded, so fast producers wait instead of filling memory
+    # An error raised by one iterable is re-raised to the consumer after the items before it have been yielded
+    buffer = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Stop producing if the consumer has gone away, rather than blocking forever on a full buffer
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(iterable):
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+        except Exception as error:
+            put((error, None))
+        finally:
+            put((finished, None))
+
+    # Iterables are only taken as threads become free, one more each time one is drained, so a lazily generated sequence of
+    # them (e.g. partitions found by listing) is never read far ahead of the items being consumed
+    # The threads are daemons, so a consumer that stops with an error can't leave the process waiting on them at exit
+    max_workers = max(1, int(max_workers))
+    iterables = iter(iterables)
+
+    def start_next():
+        for iterable in iterables:
+            threading.Thread(target=drain, args=(iterable,), daemon=True).start()
+            return 1
+        return 0
+
+    try:
+        running = sum(start_next() for _ in range(max_workers))
+        while running:
+            marker, item = buffer.get()
+            if marker is finished:
+                running += start_next() - 1
+            elif marker != None:
+                raise marker
+            else:
+                yield item
+    finally:
+        stopped.set()